@@ -0,0 +1,102 @@
+'''
+Normalizing street addresses, so the same address written differently
+(N. vs North, Street vs St, with or without a suite) gets the same key
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import re
+from functools import lru_cache
+
+
+PUNCT_RE = re.compile(r"[.,;']")
+UNIT_RE = re.compile(r'(?:#|\b(?:SUITE|STE|APT|UNIT|FLOOR|FL|ROOM|RM|BLDG|'
+                     r'SPACE|SPC)\b).*$')
+NUMBER_RE = re.compile(r'^(\d+)[A-Z]?(?:-\d+[A-Z]?)?$')
+DIRECTIONS = {'N': 'N', 'NORTH': 'N', 'S': 'S', 'SOUTH': 'S',
+              'E': 'E', 'EAST': 'E', 'W': 'W', 'WEST': 'W'}
+SUFFIXES = {'ST': 'ST', 'STREET': 'ST', 'AVE': 'AVE', 'AV': 'AVE',
+            'AVENUE': 'AVE', 'BLVD': 'BLVD', 'BOULEVARD': 'BLVD',
+            'RD': 'RD', 'ROAD': 'RD', 'DR': 'DR', 'DRIVE': 'DR',
+            'PL': 'PL', 'PLACE': 'PL', 'CT': 'CT', 'COURT': 'CT',
+            'LN': 'LN', 'LANE': 'LN', 'PKWY': 'PKWY', 'PARKWAY': 'PKWY',
+            'TER': 'TER', 'TERRACE': 'TER', 'HWY': 'HWY', 'HIGHWAY': 'HWY',
+            'PLZ': 'PLZ', 'PLAZA': 'PLZ', 'SQ': 'SQ', 'SQUARE': 'SQ',
+            'WAY': 'WAY', 'CIR': 'CIR', 'CIRCLE': 'CIR'}
+CACHE_SIZE = 65536
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_address(address):
+    '''
+    Split a street address into its street number, direction, street name
+    and suffix. Punctuation and anything from a unit (#, Suite, Apt, ...) on
+    are dropped, a range of numbers keeps its first number, and directions
+    and suffixes are abbreviated. Addresses repeat a lot, so the results
+    are memoized.
+
+    Input:
+      address (str): the street address ex) 1234-1236 North Clark St., Ste 2
+
+    Returns:
+      (tuple) number, direction, street name and suffix, '' for the parts
+      the address does not have ex) ('1234', 'N', 'CLARK', 'ST')
+    '''
+
+    address = UNIT_RE.sub('', PUNCT_RE.sub(' ', address.upper()))
+    tokens = address.split()
+    number = direction = suffix = ''
+    if tokens:
+        match = NUMBER_RE.match(tokens[0])
+        if match:
+            number = match.group(1)
+            tokens = tokens[1:]
+    # a direction or a suffix is only taken if a street name is left, as in
+    # 1600 North Ave
+    if len(tokens) > 1 and tokens[-1] in SUFFIXES:
+        suffix = SUFFIXES[tokens[-1]]
+        tokens = tokens[:-1]
+    if len(tokens) > 1 and tokens[0] in DIRECTIONS:
+        direction = DIRECTIONS[tokens[0]]
+        tokens = tokens[1:]
+    return number, direction, ' '.join(tokens), suffix
+
+
+def normalize_address(address):
+    '''
+    Get the normalized form of a street address, the key of the geocoding
+    cache and the address sent to the geocoder
+
+    Input:
+      address (str): the street address
+
+    Returns:
+      (str) the normalized address ex) 1234 N CLARK ST
+    '''
+
+    return ' '.join(part for part in parse_address(address) if part)
+
+
+def block_key(address, direction=True):
+    '''
+    Get the key of the block of inspections an address is compared with:
+    its street number, direction and street name. The suffix is left out,
+    since it is often missing or abbreviated in one of the datasets. North
+    and South Clark share their numbers, so the direction is kept; the key
+    without it is the block of every direction of the street (see
+    inspection.build_index).
+
+    Input:
+      address (str): the street address
+      direction (bool): if False, the direction is left out
+
+    Returns:
+      (str) the key ex) 1234 N CLARK, or 1234 CLARK without the direction
+    '''
+
+    number, way, street, _ = parse_address(address)
+    if not number:
+        return normalize_address(address)
+    if direction and way:
+        return '{} {} {}'.format(number, way, street)
+    return '{} {}'.format(number, street)
@@ -0,0 +1,905 @@
+'''
+Benchmarks for the data collection and processing pipeline. Network
+benchmarks run against a local stub server, so nothing is sent to
+allmenus.com.
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import io
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import zlib
+import shutil
+import tempfile
+import threading
+import tracemalloc
+import numpy as np
+import pandas as pd
+from time import sleep, perf_counter
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+SAMPLE_DIR = 'data/sample_pages/'
+STUB_LATENCY = 0.05
+STUB_MENU = {'name': 'Stub Kitchen',
+             'servesCuisine': ['Italian'],
+             'geo': {'longitude': '-87.6298', 'latitude': '41.8781'},
+             'address': {'streetAddress': '121 N LaSalle St'},
+             'hasMenu': [{'hasMenuSection': [
+                 {'hasMenuItem': [{'offers': [{'Price': '10.50'}]},
+                                  {'offers': [{'Price': '12.00'}]}]},
+                 {'hasMenuItem': [{'offers': [{'Price': '3.25'}]}]}]}]}
+STUB_PAGE = ('<html><head><script type="application/ld+json">' +
+             json.dumps(STUB_MENU) + '</script></head><body></body></html>')
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    '''
+    class storing a threaded local http server for the benchmarks
+    '''
+
+    daemon_threads = True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    '''
+    class storing a request handler that answers every GET with a restaurant
+    page after STUB_LATENCY seconds, like a slow remote host would
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        '''
+        Answer a GET request with STUB_PAGE
+        '''
+
+        sleep(STUB_LATENCY)
+        body = STUB_PAGE.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def log_message(self, format, *args):
+        '''
+        Keep the benchmark output quiet
+        '''
+
+        pass
+
+
+def start_stub_server(handler=StubHandler):
+    '''
+    Start a stub server on a free local port in a background thread
+
+    Input:
+      handler (class): the request handler class of the server
+
+    Returns:
+      server (StubServer): the running server. Call server.shutdown() to stop
+    '''
+
+    server = StubServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class RefreshHandler(StubHandler):
+    '''
+    class storing a request handler that answers with a restaurant page of
+    its own for every url. The pages whose last path part is in
+    server.changed get another name, and those in server.failing an error.
+    '''
+
+    def do_GET(self):
+        '''
+        Answer a GET request with the page of the restaurant
+        '''
+
+        name = self.path.rsplit('/', 1)[-1]
+        if name in self.server.failing:
+            self.send_error(500)
+            return
+        if name in self.server.changed:
+            name += ' (new owner)'
+        menu = dict(STUB_MENU, name='Stub Kitchen ' + name)
+        body = ('<html><head><script type="application/ld+json">' +
+                json.dumps(menu) + '</script></head><body></body></html>')
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def bench_fetch(n_pages=80, levels=(1, 2, 4, 8, 16), repeats=3):
+    '''
+    Scrape n_pages stub restaurant pages with Scraper.scrape_menus at
+    increasing concurrency and print the throughput for each level. The rate
+    limit is set high enough that only the concurrency limits throughput,
+    so the throughput must rise with the concurrency, and every level must
+    give the same dataframe as one request at a time (apart from when the
+    restaurants were scraped). Each level is timed by its fastest of
+    repeats runs, so a slow run on a busy machine does not fail the check.
+
+    Input:
+      n_pages (int): the number of stub restaurant urls to scrape
+      levels (tuple): the concurrency settings to compare
+      repeats (int): the number of runs per concurrency setting
+    '''
+
+    import scraper
+
+    server = start_stub_server()
+    base = 'http://127.0.0.1:{}/menu/'.format(server.server_address[1])
+    tmp = tempfile.mkdtemp()
+    serial, throughput = None, 0
+    for concurrency in levels:
+        elapsed = float('inf')
+        for _ in range(repeats):
+            sc = scraper.Scraper(concurrency=concurrency, rate=1000)
+            sc.url_set = {base + str(i) for i in range(n_pages)}
+            start = perf_counter()
+            df = sc.scrape_menus(path=os.path.join(tmp, 'rows.ndjson')).drop(
+                columns='Scraped_At')
+            elapsed = min(elapsed, perf_counter() - start)
+            if serial is None:
+                serial = df
+            assert df.equals(serial)
+        assert n_pages / elapsed > throughput
+        throughput = n_pages / elapsed
+        print('concurrency {:>3}: {:>7.1f} pages/sec'.format(
+            concurrency, throughput))
+    shutil.rmtree(tmp)
+    server.shutdown()
+
+
+def sample_pages():
+    '''
+    Load saved restaurant and listing pages from SAMPLE_DIR (menu_*.html and
+    listing_*.html). If there are none, build synthetic pages of a similar
+    size: a restaurant page with a large menu and a listing page with 300
+    restaurants, both padded with markup the extractors have to skip.
+
+    Returns:
+      (tuple) (menu_pages, listing_pages), two lists of html strings
+    '''
+
+    def read_all(pattern):
+        pages = []
+        for path in sorted(glob.glob(os.path.join(SAMPLE_DIR, pattern))):
+            with open(path, encoding='utf-8') as f:
+                pages.append(f.read())
+        return pages
+
+    menus, listings = read_all('menu_*.html'), read_all('listing_*.html')
+    if menus and listings:
+        return menus, listings
+    filler = '<div class="row"><span class="x">filler text</span></div>' * 2000
+    big_menu = dict(STUB_MENU)
+    big_menu['hasMenu'] = [{'hasMenuSection': [
+        {'hasMenuItem': [{'offers': [{'Price': str(i + j / 100)}]}
+                         for j in range(20)]} for i in range(30)]}]
+    menu = ('<html><head><script type="application/ld+json">' +
+            json.dumps(big_menu) + '</script></head><body>' + filler +
+            '</body></html>')
+    item = ('<li class="restaurant-list-item clearfix"><div class="s-col">'
+            '<h4 class="name"><a href="/il/chicago/{0}/menu/">Place {0}</a>'
+            '</h4><p class="address">{0} W Madison St</p>'
+            '<p class="address">Chicago, IL 60602</p>'
+            '<p class="cousine-list">Italian, Pizza</p></div></li>')
+    listing = ('<html><body>' + filler + '<ul>' +
+               ''.join(item.format(i) for i in range(300)) +
+               '</ul></body></html>')
+    return menus or [menu] * 20, listings or [listing] * 20
+
+
+def bench_refresh(n_pages=10):
+    '''
+    Scrape n_pages stub restaurants, then refresh them with one restaurant
+    no longer listed, two new ones, one whose page changed and one whose
+    rescrape fails, and check the merged dataframe: the changed restaurant
+    has its new row, the failed one keeps its previous row, and the rows
+    file rebuilds the same dataframe (see scraper.load_rows).
+
+    Input:
+      n_pages (int): the number of stub restaurants of the first scrape
+    '''
+
+    import scraper
+
+    server = start_stub_server(RefreshHandler)
+    server.changed, server.failing = set(), set()
+    base = 'http://127.0.0.1:{}/menu/'.format(server.server_address[1])
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'rows.ndjson')
+    sc = scraper.Scraper(concurrency=4, rate=1000)
+    sc.url_set = {base + str(i) for i in range(n_pages)}
+    previous = sc.scrape_menus(path=path).set_index('Url')
+    server.changed, server.failing = {'1'}, {'2'}
+    sc.url_set = {base + str(i) for i in range(1, n_pages + 2)}
+    start = perf_counter()
+    df = sc.refresh(previous.reset_index(), n_pages, path)
+    print('refresh of {} restaurants: {:.2f}s'.format(
+        n_pages, perf_counter() - start))
+    merged = df.set_index('Url')
+    assert sorted(merged.index) == sorted(sc.url_set)
+    assert merged.loc[base + '1', 'Restaurant'].endswith('(new owner)')
+    assert merged.loc[base + '1', 'Hash'] != previous.loc[base + '1', 'Hash']
+    assert merged.loc[base + '2', 'Scraped_At'] == \
+        previous.loc[base + '2', 'Scraped_At']
+    assert merged.loc[base + '3', 'Scraped_At'] > \
+        previous.loc[base + '3', 'Scraped_At']
+    assert scraper.load_rows(path).reset_index(drop=True).equals(df)
+    shutil.rmtree(tmp)
+    server.shutdown()
+
+
+def bench_extract():
+    '''
+    Compare pages/sec and peak memory of the fast extractors in extract.py
+    with the BeautifulSoup path on the sample pages
+    '''
+
+    import extract
+
+    menus, listings = sample_pages()
+    cases = [('ld+json  fast', extract.extract_ld_json, menus),
+             ('ld+json  soup', extract.soup_ld_json, menus),
+             ('listing  fast', extract.extract_listing, listings),
+             ('listing  soup', extract.soup_listing, listings)]
+    for name, func, pages in cases:
+        start = perf_counter()
+        results = [func(page) for page in pages]
+        elapsed = perf_counter() - start
+        assert all(results)
+        tracemalloc.start()
+        func(pages[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{}: {:>8.1f} pages/sec, peak {:>8.1f} MB'.format(
+            name, len(pages) / elapsed, peak / 2 ** 20))
+
+
+def synthetic_crimes(n, seed=0, years=None):
+    '''
+    Build n random crimes spread over the Chicago bounding box
+
+    Input:
+      n (int): the number of crimes
+      seed (int): seed of the random generator
+      years (int): if given, the crimes get a Date spread over this many
+                   years from 2001
+
+    Returns:
+      (pandas dataframe) crimes with the columns Longitude, Latitude and Type
+      (and Date)
+    '''
+
+    rng = np.random.RandomState(seed)
+    types = np.array(['THEFT', 'BATTERY', 'CRIMINAL DAMAGE', 'ASSAULT',
+                      'NARCOTICS', 'DECEPTIVE PRACTICE', 'BURGLARY',
+                      'ROBBERY', 'MOTOR VEHICLE THEFT', 'WEAPONS VIOLATION'])
+    crimes = pd.DataFrame({'Longitude': rng.uniform(-87.94, -87.52, n),
+                           'Latitude': rng.uniform(41.64, 42.02, n),
+                           'Type': types[rng.randint(len(types), size=n)]})
+    if years:
+        crimes['Date'] = pd.Timestamp('2001-01-01') + pd.to_timedelta(
+            rng.randint(years * 365, size=n), unit='D')
+    return crimes
+
+
+def synthetic_coordinates(n, seed=1):
+    '''
+    Build n random restaurant coordinates inside Chicago, stored as strings
+    like the coordinates scraped from allmenus.com
+
+    Input:
+      n (int): the number of coordinates
+      seed (int): seed of the random generator
+
+    Returns:
+      (pandas Series) (longitude, latitude) tuples
+    '''
+
+    rng = np.random.RandomState(seed)
+    return pd.Series([(str(lon), str(lat)) for lon, lat in
+                      zip(rng.uniform(-87.85, -87.58, n),
+                          rng.uniform(41.70, 42.00, n))])
+
+
+def reference_counts(crimes, coordinate, radius):
+    '''
+    Count crimes near one coordinate the way count_crimes used to: filter the
+    whole table to the square around it, then check every crime in the
+    square with in_radius
+
+    Input:
+      crimes (pandas dataframe): crimes with Longitude, Latitude and Type
+      coordinate (tuple): (longitude, latitude) of the location
+      radius (float): the radius in km
+
+    Returns:
+      (dict) the number of crimes of each type
+    '''
+
+    import count_crime
+
+    filt = count_crime.find_filter(coordinate, radius)
+    coordinate = (float(coordinate[0]), float(coordinate[1]))
+    crimes = crimes[(crimes['Longitude'] <= filt[0]) &
+                    (crimes['Longitude'] >= filt[1]) &
+                    (crimes['Latitude'] <= filt[2]) &
+                    (crimes['Latitude'] >= filt[3])]
+    near = [count_crime.in_radius(coordinate, loc, radius) for loc in
+            zip(crimes['Longitude'], crimes['Latitude'])]
+    return crimes[near]['Type'].value_counts().to_dict()
+
+
+def bench_crime(sizes=(250000, 1000000, 2000000), n_restaurants=2000,
+                n_check=10):
+    '''
+    Time building the crime grid index and counting the crimes around
+    n_restaurants coordinates for growing numbers of crimes, and check the
+    counts of n_check coordinates against the old row by row method. Then
+    save the index as a memory-mapped store and count again off the store,
+    and compare counting within count_crime.RADII in one pass (with a
+    Gaussian weighted count) to counting once per radius.
+
+    Input:
+      sizes (tuple): the numbers of crimes to try
+      n_restaurants (int): the number of restaurant coordinates to count for
+      n_check (int): the number of coordinates to compare with the old method
+    '''
+
+    import count_crime
+
+    coordinates = synthetic_coordinates(n_restaurants)
+    for n in sizes:
+        crimes = synthetic_crimes(n)
+        start = perf_counter()
+        index = count_crime.CrimeIndex(crimes)
+        built = perf_counter()
+        counts = index.count(coordinates, count_crime.RADIUS)
+        counted = perf_counter()
+        print('{:>9} crimes: build {:6.2f}s, count {:6.2f}s '
+              '({:>7.0f} restaurants/sec)'.format(
+                  n, built - start, counted - built,
+                  n_restaurants / (counted - built)))
+        for i in range(n_check):
+            expected = reference_counts(crimes, coordinates[i],
+                                        count_crime.RADIUS)
+            got = {t: c for t, c in zip(index.types, counts[i]) if c}
+            assert got == expected
+        tmp = tempfile.mkdtemp()
+        store = os.path.join(tmp, 'store')
+        index.save(store)
+        size = sum(os.path.getsize(os.path.join(store, f))
+                   for f in os.listdir(store))
+        start = perf_counter()
+        mapped = count_crime.CrimeIndex.load(store)
+        store_counts = mapped.count(coordinates, count_crime.RADIUS)
+        print('{:>9} store : {:6.1f} MB on disk, open and count {:6.2f}s, '
+              '{} rows differ'.format('', size / 2 ** 20,
+                                      perf_counter() - start,
+                                      (store_counts != counts).any(
+                                          axis=1).sum()))
+        start = perf_counter()
+        per_radius = [mapped.count(coordinates, radius)
+                      for radius in count_crime.RADII]
+        separate = perf_counter() - start
+        start = perf_counter()
+        profile, _ = mapped.profile(coordinates, count_crime.RADII, 0.3)
+        print('{:>9} radii : {} separately {:6.2f}s, in one pass {:6.2f}s, '
+              '{} rows differ'.format(
+                  '', len(count_crime.RADII), separate,
+                  perf_counter() - start,
+                  sum((profile[:, j] != c).any(axis=1).sum()
+                      for j, c in enumerate(per_radius))))
+        del mapped
+        shutil.rmtree(tmp)
+
+
+def bench_window(n_crimes=2000000, years=20, n_restaurants=2000,
+                 windows=(30, 90, 365, 1825), seed=5):
+    '''
+    Time counting the crimes within a time window before a random date of
+    every restaurant, for windows of growing length, with one index over
+    all the crimes that filters them by day, with the date-partitioned
+    index alone and with the partitioned index handing windows over
+    count_crime.MAX_PARTITIONS partitions to the single index. A fifth of
+    the crimes have no date and a fifth of the windows no start, and all
+    must give the same counts.
+
+    Input:
+      n_crimes (int): the number of crimes
+      years (int): the number of years the crimes are spread over
+      n_restaurants (int): the number of restaurant coordinates
+      windows (tuple): the window lengths in days
+      seed (int): seed of the random generator
+    '''
+
+    import count_crime
+
+    crimes = synthetic_crimes(n_crimes, years=years)
+    crimes.loc[crimes.sample(frac=0.2, random_state=seed).index,
+               'Date'] = pd.NaT
+    coordinates = synthetic_coordinates(n_restaurants)
+    rng = np.random.RandomState(seed)
+    ends = pd.Timestamp('2001-01-01') + pd.to_timedelta(
+        rng.randint(365, years * 365, size=n_restaurants), unit='D')
+    start = perf_counter()
+    full = count_crime.CrimeIndex(crimes)
+    built = perf_counter()
+    partitioned = count_crime.PartitionedCrimeIndex(crimes)
+    print('{} crimes over {} years: build one index {:.2f}s, {} partitions '
+          '{:.2f}s'.format(n_crimes, years, built - start,
+                           len(partitioned.partitions),
+                           perf_counter() - built))
+    end_days = count_crime.to_days(ends)
+    open_start = rng.rand(n_restaurants) < 0.2
+    for days in windows:
+        start_days = end_days - days
+        start_days[open_start] = np.iinfo('int64').min
+        start = perf_counter()
+        expected = full.count(coordinates, count_crime.RADIUS,
+                              (start_days, end_days))
+        filtered = perf_counter() - start
+        start = perf_counter()
+        counts = partitioned.count(coordinates, start_days, end_days)
+        split = perf_counter() - start
+        start = perf_counter()
+        mixed = partitioned.count(coordinates, start_days, end_days,
+                                  full=full)
+        print('{:>5} days: one index {:6.2f}s, partitions {:6.2f}s, '
+              'combined {:6.2f}s'.format(days, filtered, split,
+                                         perf_counter() - start))
+        assert (counts == expected).all() and (mixed == expected).all()
+
+
+class GeocoderHandler(BaseHTTPRequestHandler):
+    '''
+    class storing a request handler that mimics the Census Geocoder batch
+    endpoint. Every address gets a made up tract derived from its text and
+    about one address in ten has no match. The server answers a multi-row
+    batch with an error while server.fail_batches is above 0.
+    '''
+
+    def do_POST(self):
+        '''
+        Answer a batch geocoding request
+        '''
+
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        body = body.decode('utf-8')
+        part = re.search(r'filename="[^"]*"\r\n(?:[^\r\n]+\r\n)*'
+                         r'\r\n(.*?)\r\n--', body, re.S).group(1)
+        rows = list(csv.reader(part.splitlines()))
+        self.server.requests += 1
+        with self.server.lock:
+            if len(rows) > 1:
+                fail = self.server.fail_batches > 0
+                self.server.fail_batches -= fail
+            else:
+                fail = self.server.fail_singles > 0
+                self.server.fail_singles -= fail
+        if fail:
+            self.send_error(500)
+            return
+        sleep(STUB_LATENCY + len(rows) * 0.0001)
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for row in rows:
+            code = zlib.crc32(row[1].encode('utf-8'))
+            if code % 10 == 0:
+                writer.writerow([row[0], ', '.join(row[1:4]), 'No_Match'])
+                continue
+            writer.writerow([row[0], ', '.join(row[1:4]), 'Match', 'Exact',
+                             ', '.join(row[1:4]), '-87.6,41.8', '1', 'L',
+                             '17', '031', '{:06d}'.format(code % 850000),
+                             '1000'])
+        out = buf.getvalue().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+    def log_message(self, format, *args):
+        '''
+        Keep the benchmark output quiet
+        '''
+
+        pass
+
+
+def bench_geocode(n_addresses=20000, batch_size=2000, levels=(1, 4)):
+    '''
+    Geocode synthetic addresses against a stub batch geocoder with a growing
+    number of concurrent requests, then geocode them again to show the cache
+    hits, also when the addresses are spelled differently (see
+    address.normalize_address). Finally check that the addresses of a
+    failing batch are retried one at a time, and given up on after
+    tract_income.MAX_FAILURES failures in a row.
+
+    Input:
+      n_addresses (int): the number of addresses
+      batch_size (int): the number of addresses per request
+      levels (tuple): the numbers of concurrent requests to compare
+    '''
+
+    import tract_income
+    from cache import KeyValueStore
+
+    server = start_stub_server(GeocoderHandler)
+    server.lock = threading.Lock()
+    server.fail_batches = server.fail_singles = 0
+    url = 'http://127.0.0.1:{}/addressbatch'.format(server.server_address[1])
+    addresses = pd.Series(['{} W Madison St'.format(i)
+                           for i in range(n_addresses)])
+    tmp = tempfile.mkdtemp()
+    for workers in levels:
+        server.requests = 0
+        cache = KeyValueStore(os.path.join(tmp, '{}.sqlite'.format(workers)))
+        start = perf_counter()
+        tracts = tract_income.get_tracts(addresses, cache, batch_size,
+                                         workers, url)
+        elapsed = perf_counter() - start
+        print('{} workers: {:>8.0f} addresses/sec, {} requests, '
+              '{} matched'.format(workers, n_addresses / elapsed,
+                                  server.requests, tracts.notna().sum()))
+        server.requests = 0
+        start = perf_counter()
+        again = tract_income.get_tracts(addresses, cache, batch_size,
+                                        workers, url)
+        print('  rerun: {:.2f}s, {} requests'.format(
+            perf_counter() - start, server.requests))
+        assert again.equals(tracts)
+        server.requests = 0
+        respelled = addresses.str.replace(' W ', ' West ').str.replace(
+            ' St', ' Street, Suite 2')
+        again = tract_income.get_tracts(respelled, cache, batch_size,
+                                        workers, url)
+        print('  respelled rerun: {} requests'.format(server.requests))
+        assert again.equals(tracts)
+    server.requests, server.fail_batches = 0, 1
+    retried = tract_income.get_tracts(addresses[:100], None, 50, 1, url)
+    print('failed batch of 50: {} requests'.format(server.requests))
+    assert retried.equals(tracts[:100])
+    server.requests, server.fail_batches = 0, 1
+    server.fail_singles = tract_income.MAX_FAILURES
+    cache = KeyValueStore(os.path.join(tmp, 'failing.sqlite'))
+    retried = tract_income.get_tracts(addresses[:50], cache, 50, 1, url)
+    print('failing geocoder: {} requests'.format(server.requests))
+    assert server.requests == 1 + tract_income.MAX_FAILURES
+    keys = [tract_income.normalize_address(a) for a in addresses[:50]]
+    assert retried.isna().all() and not cache.get_many(keys)
+    shutil.rmtree(tmp)
+    server.shutdown()
+
+
+def synthetic_inspections(n, n_blocks=400, seed=2):
+    '''
+    Build n random inspected establishments spread over n_blocks address
+    blocks (see inspection.build_index)
+
+    Input:
+      n (int): the number of establishments
+      n_blocks (int): the number of address prefixes
+      seed (int): seed of the random generator
+
+    Returns:
+      (pandas dataframe) establishments with the columns Name, Address and
+      Result
+    '''
+
+    rng = np.random.RandomState(seed)
+    words = np.array(['Taqueria', 'Pizza', 'Grill', 'Kitchen', 'Cafe', 'Thai',
+                      'Golden', 'Dragon', 'House', 'Express', 'Bistro',
+                      'Sushi', 'Burger', 'Garden', 'Lucky', 'Star'])
+    names = [' '.join(words[rng.randint(len(words), size=rng.randint(1, 4))])
+             for _ in range(n)]
+    addresses = ['{:04d} N Clark St'.format(rng.randint(n_blocks) + 1000)
+                 for _ in range(n)]
+    results = np.array(['Pass', 'Fail', 'Pass w/ Conditions'])
+    return pd.DataFrame({'Name': names, 'Address': addresses,
+                         'Result': results[rng.randint(3, size=n)]})
+
+
+def bench_enrich(n_restaurants=4000, n_crimes=1000000, n_inspections=40000,
+                 levels=None):
+    '''
+    Time inspection matching and crime counting on a growing number of
+    worker processes (see enrich.py) and check that the results are the
+    same as the serial ones. The crimes are counted off a memory-mapped
+    store, so the workers share it.
+
+    Input:
+      n_restaurants (int): the number of restaurants
+      n_crimes (int): the number of crimes
+      n_inspections (int): the number of inspected establishments
+      levels (tuple): the numbers of processes to compare (defaults to powers
+                      of two up to the number of cores)
+    '''
+
+    import count_crime
+    import inspection
+
+    if levels is None:
+        levels = [1]
+        while levels[-1] * 2 <= (os.cpu_count() or 1):
+            levels.append(levels[-1] * 2)
+    table = synthetic_inspections(n_inspections)
+    df = table.sample(n_restaurants, replace=True, random_state=3)
+    df = pd.DataFrame({'Restaurant': df['Name'].str.upper().values,
+                       'Address': df['Address'].values,
+                       'Coordinate': synthetic_coordinates(
+                           n_restaurants).values})
+    tmp = tempfile.mkdtemp()
+    store = os.path.join(tmp, 'store')
+    count_crime.CrimeIndex(synthetic_crimes(n_crimes)).save(store)
+    count_crime.INDEX = count_crime.CrimeIndex.load(store)
+    inspection.INDEX = inspection.build_index(table)
+    serial = {}
+    for processes in levels:
+        times = []
+        start = perf_counter()
+        matches = inspection.get_inspections(df, processes=processes)
+        times.append(perf_counter() - start)
+        start = perf_counter()
+        counts = count_crime.count_crimes_batch(df['Coordinate'],
+                                                processes=processes)
+        times.append(perf_counter() - start)
+        if processes == 1:
+            serial = {'inspection': matches, 'crime': counts}
+            base = times
+        assert matches.equals(serial['inspection'])
+        assert counts.equals(serial['crime'])
+        print('{:>2} processes: inspection {:6.2f}s ({:4.1f}x), crime '
+              '{:6.2f}s ({:4.1f}x)'.format(processes, times[0],
+                                           base[0] / times[0], times[1],
+                                           base[1] / times[1]))
+    count_crime.INDEX = inspection.INDEX = None
+    shutil.rmtree(tmp)
+
+
+def reference_match(restaurant, names, results, threshold):
+    '''
+    The inspection match as it was before the batch scoring: every name of
+    the block is lowercased and scored against the restaurant, one pair at
+    a time
+
+    Input:
+      restaurant (str): the name of the restaurant
+      names (list of str): the establishment names of the block
+      results (list): the inspection results of the block
+      threshold (float): a match needs a Jaro-Winkler score above this
+
+    Returns:
+      (tuple) the inspection result and the score, or (None, NaN)
+    '''
+
+    import inspection
+
+    high_jw = threshold
+    match = None
+    for name, result in zip(names, results):
+        new_jw = inspection.jw(restaurant.lower(), name.lower())
+        if new_jw > high_jw:
+            high_jw = new_jw
+            match = result
+    if match is None:
+        return None, np.nan
+    return match, high_jw
+
+
+def bench_jw(n_restaurants=20000, n_inspections=40000, seed=6):
+    '''
+    Time matching restaurants to inspections with the pairwise loop and
+    with best_match, without and with the cache of scored pairs, in pairs
+    of names per second (the pairs of a restaurant and every name of its
+    block, scored or skipped). All three must give the same matches.
+
+    Input:
+      n_restaurants (int): the number of restaurants
+      n_inspections (int): the number of inspected establishments
+      seed (int): seed of the random generator
+    '''
+
+    import inspection
+    from address import block_key
+
+    rng = np.random.RandomState(seed)
+    table = synthetic_inspections(n_inspections)
+    df = table.sample(n_restaurants, replace=True, random_state=seed)
+    # drop a letter from half of the names, so not every match is exact
+    restaurants = [name.upper() if rng.rand() < 0.5 else
+                   name[:k] + name[k + 1:] for name, k in zip(
+                       df['Name'], rng.randint(1, 6, size=len(df)))]
+    addresses = list(df['Address'])
+    raw = {}
+    for name, address, result in zip(table['Name'], table['Address'],
+                                     table['Result']):
+        names, results = raw.setdefault(block_key(address), ([], []))
+        names.append(name)
+        results.append(result)
+    blocks = inspection.build_index(table)
+    pairs = sum(len(raw[block_key(address)][0]) for address in addresses)
+    threshold = inspection.THRESHOLD
+    cases = [('pairwise loop      ', lambda: [
+                  reference_match(r, *raw[block_key(a)], threshold)
+                  for r, a in zip(restaurants, addresses)]),
+             ('best_match         ', lambda: [
+                  inspection.match_inspection(r, a, threshold, blocks)
+                  for r, a in zip(restaurants, addresses)]),
+             ('best_match, cached ', lambda: [
+                  inspection.match_inspection(r, a, threshold, blocks, cache)
+                  for r, a in zip(restaurants, addresses)])]
+    expected = None
+    for name, func in cases:
+        cache = {}
+        start = perf_counter()
+        result = func()
+        elapsed = perf_counter() - start
+        expected = expected or result
+        assert pd.DataFrame(result).equals(pd.DataFrame(expected))
+        print('{}: {:6.2f}s ({:>10.0f} pairs/sec)'.format(
+            name, elapsed, pairs / elapsed))
+
+
+CUISINES = ['American', 'American (New)', 'Asian Fusion', 'Bagels', 'Bakery',
+            'Bar Food', 'Barbecue', 'Breakfast', 'Burgers', 'Cafe', 'Cajun',
+            'Caribbean', 'Chicago Grill', 'Chicken', 'Chinese', 'Coffee & Tea',
+            'Crepes', 'Cuban', 'Deli Food', 'Desserts', 'Dim Sum',
+            'Eclectic & International', 'Ethiopian', 'Filipino', 'French',
+            'German', 'Gluten-Free', 'Greek', 'Hawaiian', 'Healthy',
+            'Hot Dogs', 'Ice Cream', 'Indian', 'Italian', 'Jamaican',
+            'Japanese', 'Juices', 'Korean', 'Latin American', 'Lebanese',
+            'Mediterranean', 'Mexican', 'Middle Eastern', 'Noodles',
+            'Pakistani', 'Peruvian', 'Pizza', 'Polish', 'Potatoes',
+            'Pub Food', 'Ramen', 'Salads', 'Sandwiches', 'Seafood',
+            'Smoothies & Juices', 'Soul Food', 'Soup', 'Southern', 'Steak',
+            'Subs', 'Sushi', 'Tapas', 'Thai', 'Vegan', 'Vegetarian',
+            'Vietnamese', 'Wings']
+
+
+def reference_clean_cuisine_name(cuisine):
+    '''
+    Clean a cuisine name the way clean_cuisine_name used to, with
+    uncompiled patterns and an if/elif chain
+
+    Input:
+      cuisine (str): the cuisine name to be standardized
+
+    Returns:
+      cuisine (str): the standardized cuisine name
+    '''
+
+    cuisine = re.sub(r"[/\s\)]", "", cuisine.strip().lower())
+    cuisine = re.sub(r'&amp;|[\(&]', "-", cuisine)
+    if cuisine == "delifood":
+        cuisine = "deli"
+    elif cuisine == "eclectic-international":
+        cuisine = "eclectic"
+    elif cuisine == "noodles":
+        cuisine = "noodle-bar"
+    elif cuisine == "potatoes":
+        cuisine = "potato"
+    elif cuisine == "subs":
+        cuisine = "sub"
+    return cuisine
+
+
+def bench_cuisines(n_restaurants=100000, seed=4):
+    '''
+    Time mapping the cuisines of n_restaurants restaurants, each listing one
+    to four cuisines as spelled on allmenus.com (with stray spaces and html
+    escaped ampersands): one restaurant at a time with the old cleaning, one
+    restaurant at a time with the memoized cleaning, and the whole column at
+    once with map_cuisine_column. All three must give the same lists.
+
+    Input:
+      n_restaurants (int): the number of restaurants
+      seed (int): seed of the random generator
+    '''
+
+    import mapping_dict
+    import scraper
+
+    rng = np.random.RandomState(seed)
+    spellings = CUISINES + [' ' + c + ' ' for c in CUISINES] + \
+        [c.replace('&', '&amp;') for c in CUISINES if '&' in c]
+    column = [[spellings[i] for i in rng.randint(len(spellings),
+                                                  size=rng.randint(1, 5))]
+              for _ in range(n_restaurants)]
+    mapping = {reference_clean_cuisine_name(c): c.split(' ')[0]
+               for c in CUISINES[::2]}
+
+    def map_with(clean):
+        return [[mapping[clean(c)] for c in cuisines if clean(c) in mapping]
+                for cuisines in column]
+
+    cases = [('old clean, per row  ', lambda: map_with(
+                  reference_clean_cuisine_name)),
+             ('memoized, per row   ', lambda: map_with(
+                  mapping_dict.clean_cuisine_name)),
+             ('map_cuisine_column  ', lambda: scraper.map_cuisine_column(
+                  column, mapping))]
+    expected = None
+    for name, func in cases:
+        mapping_dict.clean_cuisine_name.cache_clear()
+        start = perf_counter()
+        result = func()
+        elapsed = perf_counter() - start
+        expected = expected or result
+        assert result == expected
+        print('{}: {:6.3f}s ({:>9.0f} restaurants/sec)'.format(
+            name, elapsed, n_restaurants / elapsed))
+
+
+def bench_imports(modules=('scraper', 'tract_income', 'inspection',
+                           'count_crime')):
+    '''
+    Time importing each module in a fresh interpreter, then time reading
+    every dataset whose source file exists from the source and from the
+    binary cache (kept in a temporary directory)
+
+    Input:
+      modules (tuple): the modules to import
+    '''
+
+    import subprocess
+    import datasets
+
+    code = ('from time import perf_counter; start = perf_counter(); '
+            'import {}; print(perf_counter() - start)')
+    for module in modules:
+        out = subprocess.run([sys.executable, '-c', code.format(module)],
+                             stdout=subprocess.PIPE, check=True)
+        print('import {:<13}: {:6.2f}s'.format(module, float(out.stdout)))
+    for module in modules:
+        __import__(module)
+    tmp = tempfile.mkdtemp()
+    cache_dir, datasets.CACHE_DIR = datasets.CACHE_DIR, tmp
+    for name, (path, reader, cache) in sorted(datasets.REGISTRY.items()):
+        if not os.path.exists(path):
+            print('{:<13}: {} not found, skipped'.format(name, path))
+            continue
+        times = []
+        for _ in range(2):
+            datasets.LOADED.pop(name, None)
+            start = perf_counter()
+            datasets.load(name)
+            times.append(perf_counter() - start)
+        print('{:<13}: source {:6.2f}s, cache {:6.2f}s'.format(name, *times))
+    datasets.CACHE_DIR = cache_dir
+    shutil.rmtree(tmp)
+
+
+BENCHMARKS = {'fetch': bench_fetch, 'refresh': bench_refresh,
+              'extract': bench_extract,
+              'crime': bench_crime, 'window': bench_window,
+              'geocode': bench_geocode,
+              'imports': bench_imports, 'enrich': bench_enrich,
+              'jw': bench_jw,
+              'cuisines': bench_cuisines}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print('==', name, '==')
+        BENCHMARKS[name]()
@@ -0,0 +1,351 @@
+'''
+On-disk http response cache and checkpoint journal for resumable scraping,
+a streaming writer for the scraped rows, and a persistent key-value store
+for other lookups worth keeping across runs
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import os
+import json
+import sqlite3
+import threading
+from time import time
+
+
+CACHE_PATH = 'data/http_cache.sqlite'
+JOURNAL_PATH = 'data/scrape_journal.ndjson'
+TRACT_CACHE_PATH = 'data/tract_cache.sqlite'
+TTL = 7 * 24 * 60 * 60
+
+
+class CachedResponse():
+    '''
+    class storing a response read back from the ResponseCache. Has the
+    attributes of requests.Response that the scraper uses.
+    '''
+
+    def __init__(self, url, status_code, text):
+        '''
+        Constructor for the CachedResponse class
+
+        Input:
+          url (str): the url of the response
+          status_code (int): the http status code
+          text (str): the body of the response
+        '''
+
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.from_cache = True
+
+
+class ResponseCache():
+    '''
+    class storing a SQLite backed cache of http responses keyed by url
+    '''
+
+    def __init__(self, path=CACHE_PATH, ttl=TTL):
+        '''
+        Constructor for the ResponseCache class
+
+        Input:
+          path (str): path of the SQLite file
+          ttl (float): seconds a response is used without revalidation. If
+                       None, stored responses never expire
+        '''
+
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                          'url TEXT PRIMARY KEY, status INTEGER, body TEXT, '
+                          'etag TEXT, last_modified TEXT, fetched REAL)')
+        self.conn.commit()
+
+
+    def __len__(self):
+        '''
+        Number of responses stored in the cache
+        '''
+
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM responses').fetchone()[0]
+
+
+    def lookup(self, url):
+        '''
+        Find the stored response for a url
+
+        Input:
+          url (str): the url to look up
+
+        Returns:
+          (tuple) (response, fresh, headers). response is a CachedResponse or
+          None if the url was never stored, fresh is True if the response is
+          younger than the ttl, and headers are the conditional request
+          headers to revalidate a stale response with
+        '''
+
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT status, body, etag, last_modified, fetched FROM '
+                'responses WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None, False, {}
+        status, body, etag, last_modified, fetched = row
+        fresh = self.ttl is None or time() - fetched < self.ttl
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return CachedResponse(url, status, body), fresh, headers
+
+
+    def store(self, url, rqst):
+        '''
+        Store a response. Only successful responses are stored.
+
+        Input:
+          url (str): the url the response belongs to
+          rqst (requests.Response): the response to store
+        '''
+
+        if rqst.status_code != 200:
+            return
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (url, rqst.status_code, rqst.text, rqst.headers.get('ETag'),
+                 rqst.headers.get('Last-Modified'), time()))
+            self.conn.commit()
+
+
+    def touch(self, url):
+        '''
+        Mark a stored response as fresh again after a 304 Not Modified
+
+        Input:
+          url (str): the url that was revalidated
+        '''
+
+        with self.lock:
+            self.conn.execute('UPDATE responses SET fetched = ? WHERE url = ?',
+                              (time(), url))
+            self.conn.commit()
+
+
+class KeyValueStore():
+    '''
+    class storing a persistent SQLite dictionary from strings to json
+    serializable values
+    '''
+
+    def __init__(self, path):
+        '''
+        Constructor for the KeyValueStore class
+
+        Input:
+          path (str): path of the SQLite file
+        '''
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS store ('
+                          'key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+
+
+    def __len__(self):
+        '''
+        Number of keys in the store
+        '''
+
+        with self.lock:
+            return self.conn.execute(
+                'SELECT COUNT(*) FROM store').fetchone()[0]
+
+
+    def get_many(self, keys):
+        '''
+        Look up many keys at once
+
+        Input:
+          keys (iterable of str): the keys to look up
+
+        Returns:
+          (dict) the stored value of every key that was found
+        '''
+
+        keys = list(keys)
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows = self.conn.execute(
+                    'SELECT key, value FROM store WHERE key IN ({})'.format(
+                        ', '.join('?' * len(chunk))), chunk)
+                for key, value in rows:
+                    found[key] = json.loads(value)
+        return found
+
+
+    def put_many(self, items):
+        '''
+        Store many values at once
+
+        Input:
+          items (dict): the values to store, by key
+        '''
+
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO store VALUES (?, ?)',
+                [(key, json.dumps(value)) for key, value in items.items()])
+            self.conn.commit()
+
+
+class Journal():
+    '''
+    class storing an append-only checkpoint journal of scraped restaurants.
+    Each line is a json object {"url": ...} for a restaurant that was
+    scraped, whether it had a usable menu or not. Only the urls are kept:
+    the rows themselves are in the file the scrape writes them to (see
+    Scraper.scrape_urls). A journal only covers one scrape: it lets an
+    interrupted scrape resume, and is cleared once the scrape completes.
+    '''
+
+    def __init__(self, path=JOURNAL_PATH):
+        '''
+        Constructor for the Journal class. Reads the urls already recorded
+        in path, if the file exists.
+
+        Input:
+          path (str): path of the journal file
+        '''
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            self.done.update(entry['url'] for entry in iter_ndjson(path))
+
+
+    def __len__(self):
+        '''
+        Number of recorded urls
+        '''
+
+        return len(self.done)
+
+
+    def __contains__(self, url):
+        '''
+        Check whether a url was already recorded
+        '''
+
+        return url in self.done
+
+
+    def record(self, url):
+        '''
+        Append a finished restaurant to the journal
+
+        Input:
+          url (str): the restaurant url
+        '''
+
+        with self.lock:
+            self.done.add(url)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'url': url}) + '\n')
+
+
+    def clear(self):
+        '''
+        Forget every recorded restaurant and delete the journal file, so the
+        next scrape fetches every restaurant again
+        '''
+
+        with self.lock:
+            self.done = set()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class RowWriter():
+    '''
+    class storing an NDJSON file that rows are written to one at a time, as
+    they are produced, so they never have to be held in memory together
+    '''
+
+    def __init__(self, path, append=False):
+        '''
+        Constructor for the RowWriter class. Creates the directory of path if
+        needed.
+
+        Input:
+          path (str): path of the NDJSON file
+          append (bool): if True, keep the rows already in path. Otherwise
+                         the file is started over
+        '''
+
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a' if append else 'w')
+        if append and self.file.tell():
+            # end a line left partial by an interrupted run, so the next row
+            # starts on a line of its own
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    self.file.write('\n')
+        self.count = 0
+
+
+    def write(self, row):
+        '''
+        Append a row
+
+        Input:
+          row (dict): a json serializable row
+        '''
+
+        self.file.write(json.dumps(row) + '\n')
+        self.file.flush()
+        self.count += 1
+
+
+    def close(self):
+        '''
+        Close the file
+        '''
+
+        self.file.close()
+
+
+def iter_ndjson(path):
+    '''
+    Iterate over the rows of an NDJSON file (see RowWriter), skipping the
+    lines that are not valid json: the last line of an interrupted run may
+    be partial
+
+    Input:
+      path (str): path of the NDJSON file
+
+    Returns:
+      (generator) the rows, as dicts, in file order
+    '''
+
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
@@ -5,39 +5,106 @@ each restaurant
 Nak Won Rim, Anqi Hu, Chia-yun Chang
 '''
 
+import os
+import json
+import shutil
 import pandas as pd
 import numpy as np
+import datasets
+import enrich
+from functools import partial
 from math import sin, cos, sqrt, atan2, radians
 
-CRIMES = pd.read_csv('data/crimes_type.csv')
-CRIMES.columns = ['Longitude','Latitude','Type']
-CRIMES = CRIMES[CRIMES['Type'] != 'NON-CRIMINAL']
+CRIMES_PATH = 'data/crimes_type.csv'
+STORE_DIR = 'data/crime_store'
+PARTITION_DIR = 'data/crime_partitions'
+PARTITION_FREQ = 'Q'
+# a window overlapping more partitions than this is counted with one index
+# over all the crimes, which searches the grid once instead of once per
+# partition
+MAX_PARTITIONS = 4
 LAT_MARG = 0.008994
 LON_MARG = 0.011915
+RADIUS = 0.8
+RADII = (0.4, 0.8, 1.6)
 R = 6378.1370
+NO_DAY = np.iinfo('int32').min
+INDEX = None
+PARTITIONS = None
 
-def find_filter(coordinate):
+
+def read_crimes(path):
+    '''
+    Read the crime dataset, leaving out NON-CRIMINAL incidents. If the csv
+    has a fourth column, it is read as the date of the crimes.
+
+    Input:
+      path (str): the csv file of crimes (longitude, latitude, type and
+                  optionally date)
+
+    Returns:
+      crimes (pandas dataframe): crimes with the columns Longitude, Latitude
+                                 and Type (categorical), and Date (datetime)
+                                 if the csv has dates
+    '''
+
+    names = ['Longitude', 'Latitude', 'Type', 'Date']
+    names = names[:min(len(pd.read_csv(path, nrows=0).columns), len(names))]
+    crimes = pd.read_csv(path, header=0, usecols=range(len(names)),
+                         names=names,
+                         dtype={'Longitude': 'float64',
+                                'Latitude': 'float64', 'Type': 'category'})
+    crimes = crimes[crimes['Type'] != 'NON-CRIMINAL'].reset_index(drop=True)
+    if 'Date' in crimes:
+        crimes['Date'] = pd.to_datetime(crimes['Date'], errors='coerce')
+    crimes['Type'] = crimes['Type'].cat.remove_unused_categories()
+    return crimes
+
+
+# the crime stores are the binary cache of the crimes, so the table is not
+# pickled as well
+datasets.register('crimes', CRIMES_PATH, read_crimes, cache=False)
+
+
+def find_filter(coordinate, radius=RADIUS):
     '''
     Find the coordinate of the circumscribed sqaure of the parameter.
     Filtering the coordinates first using makes in_radius much faster.
     
     Input:
       coordinate (tuple): tuple contaning the coordinate for a restaurant
+      radius (float): the radius of the parameter in km
+    '''
+
+    lon_marg, lat_marg = margins(radius)
+    return [float(coordinate[0]) + lon_marg, 
+            float(coordinate[0]) - lon_marg,
+            float(coordinate[1]) + lat_marg,
+            float(coordinate[1]) - lat_marg]
+
+
+def margins(radius):
     '''
+    Scale the margins of the circumscribed square (set for 0.8km) to a radius
 
-    return [float(coordinate[0]) + LON_MARG, 
-            float(coordinate[0]) - LON_MARG,
-            float(coordinate[1]) + LAT_MARG,
-            float(coordinate[1]) - LAT_MARG]
+    Input:
+      radius (float): the radius of the parameter in km
+
+    Returns:
+      (tuple) the longitude and latitude margins
+    '''
 
+    return LON_MARG * radius / 0.8, LAT_MARG * radius / 0.8
 
-def in_radius(loc1, loc2):
+
+def in_radius(loc1, loc2, radius=RADIUS):
     '''
     Calcuate distance in kilometer between two locations(lists or tuples). 
     Return True if distance is under 0.8km, False if not.
 
     Input:
       loc1, loc2 (tuple): (longitude, latitude) of a location coordinate
+      radius (float): the distance in km to compare with
 
     Returns:
       (Bool) True if distance is under 0.8km, False if not
@@ -52,15 +119,753 @@ def in_radius(loc1, loc2):
     a = sin(dlat / 2) ** 2 + cos(lat1) * cos(lat2) * sin(dlon / 2) ** 2
     c = 2 * atan2(sqrt(a), sqrt(1 - a))
     distance = R * c    
-    return distance < 0.8
+    return distance < radius
+
+
+def to_days(dates, missing=NO_DAY):
+    '''
+    Convert dates to whole days since 1970-01-01
+
+    Input:
+      dates (list or pandas Series): the dates (anything pd.to_datetime
+                                     reads)
+      missing (int): the day given to missing dates
+
+    Returns:
+      (numpy array) int64 days
+    '''
+
+    dates = pd.to_datetime(pd.Series(list(dates), dtype=object))
+    days = dates.values.astype('datetime64[D]').astype('int64')
+    days[dates.isna().to_numpy()] = missing
+    return days
+
+
+def distances(loc, lons, lats):
+    '''
+    Vectorized version of the distance computed in in_radius, between one
+    location and arrays of locations. The coordinates are read in the same
+    order as in_radius reads them, so both give the same results.
+
+    Input:
+      loc (tuple): (longitude, latitude) of a location coordinate
+      lons, lats (numpy arrays): longitudes and latitudes of the locations
+
+    Returns:
+      (numpy array) the distances in km
+    '''
+
+    lat1 = radians(float(loc[0]))
+    lon1 = radians(float(loc[1]))
+    lat2 = np.radians(lons)
+    lon2 = np.radians(lats)
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = (np.sin(dlat / 2) ** 2 +
+         cos(lat1) * np.cos(lat2) * np.sin(dlon / 2) ** 2)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+
+class CrimeIndex():
+    '''
+    class storing a uniform grid hash over the crime locations. Crimes are
+    sorted by grid cell, so the crimes of one column of cells are one slice
+    of the arrays.
+    '''
+
+    def __init__(self, crimes, cell=(LON_MARG, LAT_MARG), types=None):
+        '''
+        Constructor for the CrimeIndex class
+
+        Input:
+          crimes (pandas dataframe): crimes with the columns Longitude,
+                                     Latitude and Type, and optionally Date
+          cell (tuple): the width and the height of a grid cell in degrees
+          types (numpy array): the sorted crime types to code the types
+                               with. If None, the types of crimes
+        '''
+
+        # like value_counts and the square filter, skip crimes without a
+        # type or a location
+        crimes = crimes.dropna(subset=['Longitude', 'Latitude', 'Type'])
+        lon = crimes['Longitude'].to_numpy(dtype='float64')
+        lat = crimes['Latitude'].to_numpy(dtype='float64')
+        if types is None:
+            codes, types = pd.factorize(crimes['Type'], sort=True)
+        else:
+            codes = pd.Categorical(np.asarray(crimes['Type']),
+                                   categories=types).codes
+        self.types = np.asarray(types)
+        self.cell = cell
+        self.origin = (lon.min(), lat.min()) if len(lon) else (0.0, 0.0)
+        col, row = self.cell_of(lon, lat)
+        self.n_rows = int(row.max()) + 1 if len(row) else 1
+        keys = col * self.n_rows + row
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.lon = lon[order]
+        self.lat = lat[order]
+        self.codes = codes[order]
+        self.days = None
+        if 'Date' in crimes:
+            self.days = to_days(crimes['Date']).astype('int32')[order]
+        self.relative = False
+
+
+    def __len__(self):
+        '''
+        Number of crimes in the index
+        '''
+
+        return len(self.keys)
+
+
+    def coordinates(self, pos):
+        '''
+        Get the coordinates of crimes
+
+        Input:
+          pos (numpy array): positions of the crimes
+
+        Returns:
+          (tuple) float64 arrays of the longitudes and latitudes
+        '''
+
+        lon = self.lon[pos].astype('float64')
+        lat = self.lat[pos].astype('float64')
+        if self.relative:
+            col, row = np.divmod(self.keys[pos], self.n_rows)
+            lon += self.origin[0] + col * self.cell[0]
+            lat += self.origin[1] + row * self.cell[1]
+        return lon, lat
+
+
+    def save(self, directory, source_mtime=None):
+        '''
+        Write the index as a compact columnar store: float32 coordinates,
+        the type of every crime as a small integer code, the cell keys the
+        rows are sorted by, a json file with the type vocabulary and the
+        grid, and the day of every crime if the crimes have dates. The
+        coordinates are stored as offsets from the corner of their
+        cell, which keeps float32 precise to a fraction of a millimeter. The
+        store is written next to directory and then moved in place, so
+        readers never see half of it.
+
+        Input:
+          directory (str): the directory of the store
+          source_mtime (float): mtime of the csv the store was built from
+        '''
+
+        tmp = '{}.tmp{}'.format(directory, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        code_type = 'uint8' if len(self.types) <= 256 else 'uint16'
+        lon, lat = self.coordinates(np.arange(len(self)))
+        col, row = np.divmod(self.keys, self.n_rows)
+        lon -= self.origin[0] + col * self.cell[0]
+        lat -= self.origin[1] + row * self.cell[1]
+        np.save(os.path.join(tmp, 'lon.npy'), lon.astype('float32'))
+        np.save(os.path.join(tmp, 'lat.npy'), lat.astype('float32'))
+        np.save(os.path.join(tmp, 'codes.npy'), self.codes.astype(code_type))
+        key_type = 'int32' if self.keys[-1:].sum() < 2 ** 31 else 'int64'
+        np.save(os.path.join(tmp, 'keys.npy'), self.keys.astype(key_type))
+        if self.days is not None:
+            np.save(os.path.join(tmp, 'days.npy'), self.days)
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'types': [str(t) for t in self.types],
+                       'cell': list(self.cell),
+                       'origin': [float(o) for o in self.origin],
+                       'n_rows': self.n_rows,
+                       'source_mtime': source_mtime}, f)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp, directory)
+
+
+    @classmethod
+    def load(cls, directory):
+        '''
+        Open a store written by save. The arrays are memory-mapped, so
+        processes that open the same store share one copy of it through the
+        page cache.
+
+        Input:
+          directory (str): the directory of the store
+
+        Returns:
+          (CrimeIndex) the index backed by the store
+        '''
+
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls.__new__(cls)
+        index.types = np.array(meta['types'], dtype=object)
+        index.cell = tuple(meta['cell'])
+        index.origin = tuple(meta['origin'])
+        index.n_rows = meta['n_rows']
+        index.relative = True
+        for name in ['lon', 'lat', 'codes', 'keys']:
+            setattr(index, name, np.load(os.path.join(directory,
+                                                      name + '.npy'),
+                                         mmap_mode='r'))
+        days = os.path.join(directory, 'days.npy')
+        index.days = np.load(days, mmap_mode='r') \
+            if os.path.exists(days) else None
+        return index
+
+
+    def cell_of(self, lon, lat):
+        '''
+        Find the grid cell (column, row) of locations
+
+        Input:
+          lon, lat (numpy arrays or floats): the coordinates
+
+        Returns:
+          (tuple) the column and row numbers of the cells
+        '''
+
+        col = np.floor((lon - self.origin[0]) / self.cell[0]).astype('int64')
+        row = np.floor((lat - self.origin[1]) / self.cell[1]).astype('int64')
+        return col, row
+
+
+    def candidates(self, coordinate, radius=RADIUS):
+        '''
+        Find the crimes in the circumscribed square of the parameter, using
+        only the grid cells the square overlaps
+
+        Input:
+          coordinate (tuple): (longitude, latitude) of a location coordinate
+          radius (float): the radius of the parameter in km
+
+        Returns:
+          (numpy array) positions of the crimes in the square
+        '''
+
+        filt = find_filter(coordinate, radius)
+        col_lo, row_lo = self.cell_of(filt[1], filt[3])
+        col_hi, row_hi = self.cell_of(filt[0], filt[2])
+        row_lo, row_hi = max(row_lo, 0), min(row_hi, self.n_rows - 1)
+        if row_lo > row_hi:
+            return np.array([], dtype='int64')
+        cols = np.arange(max(col_lo, 0), col_hi + 1)
+        # search with the dtype of the keys, or numpy converts all the keys
+        lo = (cols * self.n_rows + row_lo).astype(self.keys.dtype)
+        hi = (cols * self.n_rows + row_hi).astype(self.keys.dtype)
+        starts = np.searchsorted(self.keys, lo)
+        ends = np.searchsorted(self.keys, hi, side='right')
+        pos = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]
+                             + [np.array([], dtype='int64')])
+        lon, lat = self.coordinates(pos)
+        inside = ((lon <= filt[0]) & (lon >= filt[1]) &
+                  (lat <= filt[2]) & (lat >= filt[3]))
+        return pos[inside]
+
+
+    def count(self, coordinates, radius=RADIUS, windows=None):
+        '''
+        Count the crimes of each type within radius km of every coordinate
+
+        Input:
+          coordinates (pandas Series): (longitude, latitude) of the locations
+          radius (float): the radius in km
+          windows (tuple): (starts, ends), arrays of the first day and the
+                           day after the last day (see to_days) of the
+                           crimes to count around every coordinate. If None,
+                           all crimes are counted
+
+        Returns:
+          counts (numpy array): int32 counts, one row per coordinate, one
+                                column per type in self.types
+        '''
+
+        if windows is not None and self.days is None:
+            raise ValueError('the crimes of the index have no dates')
+        counts = np.zeros((len(coordinates), len(self.types)), dtype='int32')
+        for i, coordinate in enumerate(coordinates):
+            coordinate = (float(coordinate[0]), float(coordinate[1]))
+            pos = self.candidates(coordinate, radius)
+            near = distances(coordinate, *self.coordinates(pos)) < radius
+            if windows is not None:
+                # undated crimes are in no window, open or not, as in the
+                # partitions, which leave them out
+                days = self.days[pos]
+                near &= ((days != NO_DAY) & (days >= windows[0][i]) &
+                         (days < windows[1][i]))
+            counts[i] = np.bincount(self.codes[pos[near]],
+                                    minlength=len(self.types))
+        return counts
+
+
+    def profile(self, coordinates, radii=RADII, bandwidth=None):
+        '''
+        Count the crimes of each type within several radii of every
+        coordinate, and optionally a Gaussian kernel density, in one pass.
+        The candidates of a coordinate are found once for the largest
+        radius, their distances are computed once, and every crime is binned
+        into the smallest radius it counts for, so the counts of each radius
+        are the cumulative sums of the bins. A crime counts for a radius
+        under the same rule as in count (inside the square of the radius and
+        closer than the radius), so the counts are the same as calling count
+        once per radius.
+
+        Input:
+          coordinates (pandas Series): (longitude, latitude) of the locations
+          radii (tuple): the radii in km
+          bandwidth (float): the bandwidth in km of the Gaussian kernel. If
+                             None, no density is computed
+
+        Returns:
+          (tuple) (counts, density). counts is an int32 array of shape
+          (coordinates, radii, types), with the radii in increasing order.
+          density is a float64 array of shape (coordinates, types): the
+          Gaussian weighted count, the sum of exp(-d^2 / 2 bandwidth^2) over
+          the crimes closer than the largest radius, with d the same
+          distance the counts use. It is None if bandwidth is None
+        '''
+
+        radii = np.sort(np.asarray(radii, dtype='float64'))
+        n_types = len(self.types)
+        counts = np.zeros((len(coordinates), len(radii), n_types),
+                          dtype='int32')
+        density = None
+        if bandwidth is not None:
+            density = np.zeros((len(coordinates), n_types))
+        for i, coordinate in enumerate(coordinates):
+            coordinate = (float(coordinate[0]), float(coordinate[1]))
+            pos = self.candidates(coordinate, radii[-1])
+            lon, lat = self.coordinates(pos)
+            dist = distances(coordinate, lon, lat)
+            codes = self.codes[pos]
+            # first radius the crime is closer than, then pushed out past
+            # the radii whose square the crime is not in
+            first = np.searchsorted(radii, dist, side='right')
+            for j, radius in enumerate(radii[:-1]):
+                filt = find_filter(coordinate, radius)
+                outside = ((lon > filt[0]) | (lon < filt[1]) |
+                           (lat > filt[2]) | (lat < filt[3]))
+                first[outside] = np.maximum(first[outside], j + 1)
+            bins = np.bincount(first * n_types + codes,
+                               minlength=(len(radii) + 1) * n_types)
+            counts[i] = np.cumsum(bins.reshape(-1, n_types)[:-1], axis=0)
+            if density is not None:
+                near = dist < radii[-1]
+                weights = np.exp(-0.5 * (dist[near] / bandwidth) ** 2)
+                density[i] = np.bincount(codes[near], weights=weights,
+                                         minlength=n_types)
+        return counts, density
+
+
+class PartitionedCrimeIndex():
+    '''
+    class storing the crimes split by date into partitions (one per quarter
+    by default), each with its own CrimeIndex. Counting within a time window
+    only opens and searches the partitions the window overlaps, so it pays
+    off for short windows (see count).
+    '''
+
+    def __init__(self, crimes, cell=(LON_MARG, LAT_MARG),
+                 freq=PARTITION_FREQ):
+        '''
+        Constructor for the PartitionedCrimeIndex class
+
+        Input:
+          crimes (pandas dataframe): crimes with the columns Longitude,
+                                     Latitude, Type and Date. Crimes without
+                                     a date are left out
+          cell (tuple): the width and the height of a grid cell in degrees
+          freq (str): the pandas period of a partition
+        '''
+
+        crimes = crimes.dropna(subset=['Longitude', 'Latitude', 'Type'])
+        _, types = pd.factorize(crimes['Type'], sort=True)
+        self.types = np.asarray(types)
+        self.partitions = []
+        self.indexes = {}
+        self.directory = None
+        periods = crimes['Date'].dt.to_period(freq)
+        for period, group in crimes.groupby(periods, sort=True):
+            start, end = to_days([period.start_time, (period + 1).start_time])
+            self.partitions.append((str(period), int(start), int(end)))
+            self.indexes[str(period)] = CrimeIndex(group, cell, self.types)
+
+
+    def partition(self, name):
+        '''
+        Get the index of a partition, opening it from the store on first use
+
+        Input:
+          name (str): the name of the partition, ex) 2019Q1
+
+        Returns:
+          (CrimeIndex) the index over the crimes of the partition
+        '''
+
+        if name not in self.indexes:
+            self.indexes[name] = CrimeIndex.load(os.path.join(self.directory,
+                                                              name))
+        return self.indexes[name]
+
+
+    def save(self, directory, source_mtime=None):
+        '''
+        Write every partition as a crime store (see CrimeIndex.save) in a
+        subdirectory named after it, and a json file with the type
+        vocabulary and the days each partition covers
+
+        Input:
+          directory (str): the directory of the store
+          source_mtime (float): mtime of the csv the store was built from
+        '''
+
+        tmp = '{}.tmp{}'.format(directory, os.getpid())
+        os.makedirs(tmp, exist_ok=True)
+        for name, _, _ in self.partitions:
+            self.partition(name).save(os.path.join(tmp, name))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+            json.dump({'types': [str(t) for t in self.types],
+                       'partitions': self.partitions,
+                       'source_mtime': source_mtime}, f)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.rename(tmp, directory)
+
+
+    @classmethod
+    def load(cls, directory):
+        '''
+        Open a store written by save. The partitions themselves are only
+        opened when a window overlaps them.
+
+        Input:
+          directory (str): the directory of the store
+
+        Returns:
+          (PartitionedCrimeIndex) the index backed by the store
+        '''
+
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls.__new__(cls)
+        index.types = np.array(meta['types'], dtype=object)
+        index.partitions = [tuple(p) for p in meta['partitions']]
+        index.indexes = {}
+        index.directory = directory
+        return index
+
+
+    def count(self, coordinates, starts, ends, radius=RADIUS, full=None):
+        '''
+        Count the crimes of each type within radius km of every coordinate
+        that happened within its time window. Every partition a window
+        overlaps searches the grid again, so a window overlapping more than
+        MAX_PARTITIONS partitions is counted with full instead, if given.
+
+        Input:
+          coordinates (pandas Series): (longitude, latitude) of the locations
+          starts (numpy array): the first day of every window (see to_days)
+          ends (numpy array): the day after the last day of every window
+          radius (float): the radius in km
+          full (CrimeIndex): an index over the same crimes with their dates
+                             (see get_index, optional)
+
+        Returns:
+          counts (numpy array): int32 counts, one row per coordinate, one
+                                column per type in self.types
+        '''
+
+        counts = np.zeros((len(coordinates), len(self.types)), dtype='int32')
+        wide = np.zeros(len(coordinates), dtype=bool)
+        if full is not None:
+            overlaps = np.zeros(len(coordinates), dtype='int64')
+            for _, start, end in self.partitions:
+                overlaps += (starts < end) & (ends > start)
+            wide = overlaps > MAX_PARTITIONS
+            hit = np.flatnonzero(wide)
+            if len(hit):
+                counts[hit] = full.count(coordinates.iloc[hit], radius,
+                                         (starts[hit], ends[hit]))
+        for name, start, end in self.partitions:
+            hit = np.flatnonzero((starts < end) & (ends > start) & ~wide)
+            if len(hit):
+                counts[hit] += self.partition(name).count(
+                    coordinates.iloc[hit], radius, (starts[hit], ends[hit]))
+        return counts
+
+
+def store_is_current(directory=STORE_DIR, path=CRIMES_PATH):
+    '''
+    Check whether the crime store was built from the current crime csv
+
+    Input:
+      directory (str): the directory of the store
+      path (str): the crime csv
+
+    Returns:
+      (bool) True if the store exists and matches the csv's mtime
+    '''
+
+    meta = os.path.join(directory, 'meta.json')
+    if not os.path.exists(meta):
+        return False
+    with open(meta) as f:
+        return json.load(f)['source_mtime'] == os.path.getmtime(path)
+
+
+def get_index():
+    '''
+    Get the crime index, opening the memory-mapped crime store on the first
+    call. The store is (re)built from the crime csv if it is missing or out
+    of date.
+
+    Returns:
+      (CrimeIndex) the index over the crime dataset
+    '''
+
+    global INDEX
+    if INDEX is None:
+        if not store_is_current():
+            CrimeIndex(datasets.load('crimes')).save(
+                STORE_DIR, os.path.getmtime(CRIMES_PATH))
+            datasets.unload('crimes')
+        INDEX = CrimeIndex.load(STORE_DIR)
+    return INDEX
+
+
+def get_partitions():
+    '''
+    Get the date-partitioned crime index, opening its store on the first
+    call. The store is (re)built from the crime csv if it is missing or out
+    of date.
+
+    Returns:
+      (PartitionedCrimeIndex) the index over the crime dataset
+    '''
+
+    global PARTITIONS
+    if PARTITIONS is None:
+        if not store_is_current(PARTITION_DIR):
+            crimes = datasets.load('crimes')
+            dated = 'Date' in crimes
+            if dated:
+                PartitionedCrimeIndex(crimes).save(
+                    PARTITION_DIR, os.path.getmtime(CRIMES_PATH))
+            datasets.unload('crimes')
+            if not dated:
+                raise ValueError('the crimes in {} have no dates'.format(
+                    CRIMES_PATH))
+        PARTITIONS = PartitionedCrimeIndex.load(PARTITION_DIR)
+    return PARTITIONS
+
+
+def count_chunk(coordinates, radius):
+    '''
+    Count the crimes of each type around a chunk of coordinates, in a worker
+    process (see enrich.py)
+
+    Input:
+      coordinates (pandas Series): (longitude, latitude) of the locations
+      radius (float): the radius in km
+
+    Returns:
+      (numpy array) the count matrix built by CrimeIndex.count
+    '''
+
+    return get_index().count(coordinates, radius)
+
+
+def count_crimes_batch(coordinates, radius=RADIUS, processes=1):
+    '''
+    Count the number of crimes that happened within radius km of every
+    coordinate in one call
+
+    Input:
+      coordinates (pandas Series): (longitude, latitude) of the locations
+      radius (float): the radius in km
+      processes (int): the number of worker processes the coordinates are
+                       split across
+
+    Returns:
+      counts (pandas dataframe): the int32 number of crimes of each type and
+                                 their SUM for each coordinate, indexed like
+                                 coordinates. The columns are always every
+                                 type of crime_types(), in that order, and SUM
+    '''
+
+    types = crime_types()
+    matrix = np.vstack(
+        enrich.run_chunks(partial(count_chunk, radius=radius), coordinates,
+                          processes, [get_index]) +
+        [np.zeros((0, len(types)), dtype='int32')])
+    matrix = np.column_stack([matrix, matrix.sum(axis=1, dtype='int32')])
+    return pd.DataFrame(matrix, index=coordinates.index,
+                        columns=types + ['SUM'])
+
+
+def crime_types():
+    '''
+    Get the vocabulary of crime types: every type in the crime dataset,
+    sorted. It is built once with the crime store and kept in its meta.json.
+
+    Returns:
+      (list of str) the crime types
+    '''
+
+    return [str(t) for t in get_index().types]
+
+
+def profile_chunk(coordinates, radii, bandwidth):
+    '''
+    Compute the crime profile (see CrimeIndex.profile) of a chunk of
+    coordinates, in a worker process (see enrich.py)
+
+    Input:
+      coordinates (pandas Series): (longitude, latitude) of the locations
+      radii (tuple): the radii in km
+      bandwidth (float): the bandwidth in km of the Gaussian kernel, or None
+
+    Returns:
+      (tuple) the counts and density built by CrimeIndex.profile
+    '''
+
+    return get_index().profile(coordinates, radii, bandwidth)
+
+
+def column_name(name, radius):
+    '''
+    Name the column of a crime type (or SUM) counted within a radius
+
+    Input:
+      name (str): the crime type or SUM
+      radius (float): the radius in km
+
+    Returns:
+      (str) the column name, ex) THEFT_0.4
+    '''
+
+    return '{}_{:g}'.format(name, radius)
+
+
+def count_crimes_profile(coordinates, radii=RADII, bandwidth=None,
+                         processes=1):
+    '''
+    Count the number of crimes within several radii of every coordinate, and
+    optionally their Gaussian weighted count, in one pass over the crimes
+    around each coordinate (see CrimeIndex.profile)
+
+    Input:
+      coordinates (pandas Series): (longitude, latitude) of the locations
+      radii (tuple): the radii in km
+      bandwidth (float): the bandwidth in km of the Gaussian kernel. If None,
+                         no density is computed
+      processes (int): the number of worker processes the coordinates are
+                       split across
+
+    Returns:
+      counts (pandas dataframe): indexed like coordinates. For every radius
+                                 in increasing order, the int32 count of
+                                 every type of crime_types() and their SUM,
+                                 named by column_name (THEFT_0.4, SUM_0.4).
+                                 With a bandwidth, the Gaussian weighted
+                                 count of every type and of all crimes
+                                 (DENSITY_THEFT, DENSITY_SUM)
+    '''
+
+    types = crime_types()
+    radii = sorted(radii)
+    chunks = enrich.run_chunks(partial(profile_chunk, radii=radii,
+                                       bandwidth=bandwidth),
+                               coordinates, processes, [get_index])
+    counts = np.concatenate(
+        [chunk[0] for chunk in chunks] +
+        [np.zeros((0, len(radii), len(types)), dtype='int32')])
+    columns = {}
+    for j, radius in enumerate(radii):
+        for k, crime_type in enumerate(types):
+            columns[column_name(crime_type, radius)] = counts[:, j, k]
+        columns[column_name('SUM', radius)] = counts[:, j].sum(
+            axis=1, dtype='int32')
+    if bandwidth is not None:
+        density = np.concatenate([chunk[1] for chunk in chunks] +
+                                 [np.zeros((0, len(types)))])
+        for k, crime_type in enumerate(types):
+            columns['DENSITY_' + crime_type] = density[:, k]
+        columns['DENSITY_SUM'] = density.sum(axis=1)
+    return pd.DataFrame(columns, index=coordinates.index,
+                        columns=list(columns))
+
+
+def window_chunk(windows, radius):
+    '''
+    Count the crimes within the time windows of a chunk of coordinates, in a
+    worker process (see enrich.py)
+
+    Input:
+      windows (pandas dataframe): the columns Coordinate, Start and End (see
+                                  count_crimes_window)
+      radius (float): the radius in km
+
+    Returns:
+      (numpy array) the counts built by PartitionedCrimeIndex.count
+    '''
+
+    return get_partitions().count(windows['Coordinate'],
+                                  windows['Start'].to_numpy(),
+                                  windows['End'].to_numpy(), radius,
+                                  get_index())
+
+
+def count_crimes_window(coordinates, starts, ends, radius=RADIUS,
+                        processes=1):
+    '''
+    Count the number of crimes of each type within radius km of every
+    coordinate that happened within a time window of its own, ex) the 90
+    days before the inspection of every restaurant. Only the date
+    partitions a window overlaps are searched, so the work grows with the
+    length of the windows rather than with the whole crime history; windows
+    overlapping more than MAX_PARTITIONS partitions are counted with the
+    index over all the crimes instead.
+
+    Input:
+      coordinates (pandas Series): (longitude, latitude) of the locations
+      starts (list or pandas Series): the start of every window (included).
+                                      A missing start leaves the window open
+      ends (list or pandas Series): the end of every window (excluded). A
+                                    missing end leaves the window open
+      radius (float): the radius in km
+      processes (int): the number of worker processes the coordinates are
+                       split across
+
+    Returns:
+      counts (pandas dataframe): the int32 number of crimes of each type and
+                                 their SUM for each coordinate, indexed and
+                                 with columns like count_crimes_batch
+    '''
+
+    types = [str(t) for t in get_partitions().types]
+    windows = pd.DataFrame({
+        'Coordinate': list(coordinates),
+        'Start': to_days(starts, np.iinfo('int64').min),
+        'End': to_days(ends, np.iinfo('int64').max)})
+    matrix = np.vstack(
+        enrich.run_chunks(partial(window_chunk, radius=radius), windows,
+                          processes, [get_partitions, get_index]) +
+        [np.zeros((0, len(types)), dtype='int32')])
+    matrix = np.column_stack([matrix, matrix.sum(axis=1, dtype='int32')])
+    return pd.DataFrame(matrix, index=coordinates.index,
+                        columns=types + ['SUM'])
 
 
-def count_crimes(coordinate):
+def count_crimes(coordinate, radius=RADIUS, window=None):
     '''
     Count the number of crimes that happened within 0.8km of given coordinate
     
     Input:
       coordinate (tuple): (longitude, latitude) of a location coordinate
+      radius (float): the radius in km
+      window (tuple): (start, end) dates. If given, only the crimes from
+                      start up to (not including) end are counted
 
     Returns:
       counts (pandas Series): a Series containing the number of crimes that
@@ -68,16 +873,12 @@ def count_crimes(coordinate):
                               indexed by the type of the crime
     '''
 
-    filt = find_filter(coordinate)
-    coordinate = (float(coordinate[0]), float(coordinate[1]))
-    crimes = CRIMES[(CRIMES['Longitude'] <= filt[0]) & 
-                    (CRIMES['Longitude'] >= filt[1]) &
-                    (CRIMES['Latitude'] <= filt[2]) & 
-                    (CRIMES['Latitude'] >= filt[3])]
-    tmp = crimes.apply(lambda x: in_radius(coordinate,
-                                           (x['Longitude'], x['Latitude'])),
-                                           axis=1)
-    crimes = crimes[tmp]
-    counts = crimes['Type'].value_counts()
-    counts = counts.append(pd.Series({'SUM': sum(counts)}))
-    return counts
+    if window is None:
+        counts = count_crimes_batch(pd.Series([coordinate]), radius)
+    else:
+        counts = count_crimes_window(pd.Series([coordinate]), [window[0]],
+                                     [window[1]], radius)
+    counts = counts.iloc[0]
+    counts = counts.drop('SUM')
+    counts = counts[counts > 0].sort_values(ascending=False)
+    return pd.concat([counts, pd.Series({'SUM': counts.sum()})])
@@ -0,0 +1,95 @@
+'''
+Lazy, cached loading of the datasets used by the pipeline. Each module
+registers the datasets it needs with a reader that keeps only the needed
+columns. A dataset is read on first use and a pickled copy is written to
+CACHE_DIR, which is reused until the source file's mtime changes.
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import os
+import pickle
+import profiling
+
+
+CACHE_DIR = 'data/cache'
+REGISTRY = {}
+LOADED = {}
+
+
+def register(name, path, reader, cache=True):
+    '''
+    Register a dataset
+
+    Input:
+      name (str): the name of the dataset
+      path (str): the source file of the dataset
+      reader (function): function taking path and returning the dataset
+      cache (bool): if True, keep a pickled copy of what reader returned in
+                    CACHE_DIR
+    '''
+
+    REGISTRY[name] = (path, reader, cache)
+
+
+def cache_path(name):
+    '''
+    Get the path of the cached copy of a dataset
+
+    Input:
+      name (str): the name of the dataset
+
+    Returns:
+      (str) the path of the pickle file
+    '''
+
+    return os.path.join(CACHE_DIR, name + '.pkl')
+
+
+def load(name):
+    '''
+    Get a dataset, reading it on the first call. The source file is read
+    only if there is no cached copy made from the same version of it.
+
+    Input:
+      name (str): the name of the dataset
+
+    Returns:
+      the dataset, as returned by its reader
+    '''
+
+    path, reader, cache = REGISTRY[name]
+    mtime = os.path.getmtime(path)
+    if name in LOADED and LOADED[name][0] == mtime:
+        return LOADED[name][1]
+    data = None
+    if cache and os.path.exists(cache_path(name)):
+        with open(cache_path(name), 'rb') as pkl:
+            cached_mtime, cached = pickle.load(pkl)
+        if cached_mtime == mtime:
+            data = cached
+            profiling.add('dataset_cache.hits')
+    if data is None:
+        with profiling.timer('dataset.read_seconds'):
+            data = reader(path)
+        if cache:
+            profiling.add('dataset_cache.misses')
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp = '{}.tmp{}'.format(cache_path(name), os.getpid())
+            with open(tmp, 'wb') as pkl:
+                pickle.dump((mtime, data), pkl, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache_path(name))
+    LOADED[name] = (mtime, data)
+    return data
+
+
+def unload(name):
+    '''
+    Drop a loaded dataset from memory. The next load reads it again (from
+    the cached copy if there is one).
+
+    Input:
+      name (str): the name of the dataset
+    '''
+
+    LOADED.pop(name, None)
@@ -0,0 +1,129 @@
+'''
+Running the row-wise enrichment steps (inspection matching, crime counting)
+on chunks of the restaurant table across a pool of processes. Pipeline
+stages that run at the same time share one pool (see shared_pool), so they
+do not start a pool each from their threads.
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import os
+from functools import partial
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+
+PROCESSES = os.cpu_count() or 1
+CHUNKS_PER_PROCESS = 4
+POOL = None
+
+
+def split(frame, n_chunks):
+    '''
+    Cut a table into consecutive chunks of about the same length
+
+    Input:
+      frame (pandas dataframe or series): the table to cut
+      n_chunks (int): the number of chunks
+
+    Returns:
+      (list) the non empty chunks, in order
+    '''
+
+    n_chunks = max(min(n_chunks, len(frame)), 1)
+    bounds = [len(frame) * i // n_chunks for i in range(n_chunks + 1)]
+    return [frame.iloc[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def init_worker(loaders):
+    '''
+    Load the reference data of a worker process once, before it runs any
+    chunk
+
+    Input:
+      loaders (list of functions): functions that load and keep the
+                                   reference data (e.g. count_crime.get_index)
+    '''
+
+    for loader in loaders:
+        loader()
+
+
+def run_loaded(func, loaders, chunk):
+    '''
+    Run func on a chunk in a worker of the shared pool, loading the reference
+    data first. The loaders keep what they load, so a worker only loads it
+    for its first chunk.
+
+    Input:
+      func (function): takes a chunk and returns its result
+      loaders (list of functions): see init_worker
+      chunk (pandas dataframe or series): the chunk
+
+    Returns:
+      the result of func
+    '''
+
+    init_worker(loaders)
+    return func(chunk)
+
+
+@contextmanager
+def shared_pool(processes=PROCESSES):
+    '''
+    Start the pool of worker processes that run_chunks uses for as long as
+    the block runs. Enter it before starting any thread (as Pipeline.run
+    does): forking a process whose other threads hold locks can deadlock the
+    workers, and stages running at the same time with a pool each would
+    start more processes than there are cpus.
+
+    Input:
+      processes (int): the number of worker processes. With a single
+                       process, no pool is started
+    '''
+
+    global POOL
+    if processes <= 1 or POOL is not None:
+        yield
+        return
+    with Pool(processes) as pool:
+        POOL = pool
+        try:
+            yield
+        finally:
+            POOL = None
+
+
+def run_chunks(func, frame, processes=PROCESSES, loaders=(),
+               chunks_per_process=CHUNKS_PER_PROCESS):
+    '''
+    Run a function over chunks of a table, on a pool of processes. func must
+    be picklable (a module level function or a functools.partial of one). A
+    single process runs func on the whole table in this process. Inside
+    shared_pool, the chunks go to the shared pool, whose workers run the
+    loaders before their first chunk; otherwise a pool is started for this
+    call. The loaders run in this process first, so data they build on disk
+    (e.g. the crime store) is built once.
+
+    Input:
+      func (function): takes a chunk of frame and returns its result
+      frame (pandas dataframe or series): the table
+      processes (int): the number of worker processes
+      loaders (list of functions): run once in every worker when it starts
+      chunks_per_process (int): the table is cut in this many chunks per
+                                process, so slower chunks even out
+
+    Returns:
+      (list) the result of every chunk, in the order of frame
+    '''
+
+    if processes <= 1 or len(frame) < 2:
+        return [func(frame)]
+    chunks = split(frame, processes * chunks_per_process)
+    init_worker(loaders)
+    pool = POOL
+    if pool is not None:
+        return pool.map(partial(run_loaded, func, list(loaders)), chunks)
+    with Pool(processes, initializer=init_worker,
+              initargs=(list(loaders),)) as pool:
+        return pool.map(func, chunks)
@@ -0,0 +1,199 @@
+'''
+Fast extraction of the ld+json block and the restaurant list items from
+allmenus.com pages without building a BeautifulSoup tree. Falls back to
+BeautifulSoup when the fast path finds nothing.
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import re
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup
+
+
+LD_JSON_RE = re.compile(r'<script\b[^>]*\btype\s*=\s*["\']?'
+                        r'application/ld\+json["\']?[^>]*>(.*?)</script\s*>',
+                        re.S | re.I)
+NEXT_RE = re.compile(r'<(?:link|a)\b[^>]*\brel\s*=\s*["\']?next\b[^>]*>',
+                     re.I)
+HREF_RE = re.compile(r'\bhref\s*=\s*["\']([^"\']*)["\']', re.I)
+
+
+def extract_ld_json(html):
+    '''
+    Get the text of the first <script type="application/ld+json"> tag
+
+    Input:
+      html (str): the html of the page
+
+    Returns:
+      (str) the text inside the script tag, or None if there is none
+    '''
+
+    match = LD_JSON_RE.search(html)
+    if match:
+        return match.group(1)
+    return soup_ld_json(html)
+
+
+def soup_ld_json(html):
+    '''
+    Get the text of the first <script type="application/ld+json"> tag by
+    parsing the whole page with BeautifulSoup
+
+    Input:
+      html (str): the html of the page
+
+    Returns:
+      (str) the text inside the script tag, or None if there is none
+    '''
+
+    soup = BeautifulSoup(html, 'html.parser')
+    tag = soup.find('script', type='application/ld+json')
+    if tag is None:
+        return None
+    return tag.text
+
+
+class ListingParser(HTMLParser):
+    '''
+    class storing a streaming html parser that only keeps the address texts,
+    the link and the cuisine list of every <li class="restaurant-list-item">
+    it sees
+    '''
+
+    def __init__(self):
+        '''
+        Constructor for the ListingParser class
+        '''
+
+        super().__init__()
+        self.items = []
+        self.li_depth = 0
+        self.in_address = False
+        self.in_cuisines = False
+        self.addresses = []
+        self.href = None
+        self.cuisines = None
+
+
+    def handle_starttag(self, tag, attrs):
+        '''
+        Track the restaurant list item, address, cuisine list and link tags
+        '''
+
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if tag == 'li':
+            if self.li_depth:
+                self.li_depth += 1
+            elif 'restaurant-list-item' in classes:
+                self.li_depth = 1
+                self.addresses = []
+                self.href = None
+                self.cuisines = None
+        elif not self.li_depth:
+            return
+        elif tag == 'p' and 'address' in classes:
+            self.in_address = True
+            self.addresses.append('')
+        elif tag == 'p' and 'cousine-list' in classes:
+            self.in_cuisines = True
+            self.cuisines = ''
+        elif tag == 'a' and 'class' not in attrs and self.href is None:
+            self.href = attrs.get('href')
+
+
+    def handle_endtag(self, tag):
+        '''
+        Close the restaurant list item, address and cuisine list tags
+        '''
+
+        if not self.li_depth:
+            return
+        if tag == 'p':
+            self.in_address = False
+            self.in_cuisines = False
+        elif tag == 'li':
+            self.li_depth -= 1
+            if not self.li_depth:
+                self.items.append((self.addresses, self.href, self.cuisines))
+
+
+    def handle_data(self, data):
+        '''
+        Collect the text of an address or cuisine list tag
+        '''
+
+        if self.in_address:
+            self.addresses[-1] += data
+        elif self.in_cuisines:
+            self.cuisines += data
+
+
+def extract_listing(html):
+    '''
+    Get the address texts, the link and the cuisine list of every restaurant
+    in a cuisine listing page
+
+    Input:
+      html (str): the html of the listing page
+
+    Returns:
+      (list of tuples) (addresses, href, cuisines) for each restaurant list
+      item, where addresses is the list of texts of its <p class="address">
+      tags and cuisines the text of its <p class="cousine-list"> tag (None
+      if it has none)
+    '''
+
+    parser = ListingParser()
+    start = html.find('restaurant-list-item')
+    if start != -1:
+        parser.feed(html[max(html.rfind('<li', 0, start), 0):])
+    parser.close()
+    if parser.items:
+        return parser.items
+    return soup_listing(html)
+
+
+def soup_listing(html):
+    '''
+    Get the address texts, the link and the cuisine list of every restaurant
+    in a cuisine listing page by parsing the whole page with BeautifulSoup
+
+    Input:
+      html (str): the html of the listing page
+
+    Returns:
+      (list of tuples) (addresses, href, cuisines) for each restaurant list
+      item
+    '''
+
+    soup = BeautifulSoup(html, 'html.parser')
+    items = []
+    for r in soup.find_all('li', class_='restaurant-list-item'):
+        link = r.find('a', class_=None)
+        cuisines = r.find('p', class_='cousine-list')
+        items.append(([p.text for p in r.find_all('p', class_='address')],
+                      link.get('href') if link else None,
+                      cuisines.text if cuisines else None))
+    return items
+
+
+def extract_next_page(html):
+    '''
+    Get the link to the next page of a paginated listing, from a
+    <link rel="next"> or <a rel="next"> tag
+
+    Input:
+      html (str): the html of the listing page
+
+    Returns:
+      (str) the href of the next page, or None if it is the last page
+    '''
+
+    for match in NEXT_RE.finditer(html):
+        href = HREF_RE.search(match.group(0))
+        if href:
+            return href.group(1).replace('&amp;', '&')
+    return None
@@ -0,0 +1,188 @@
+'''
+Concurrent, rate limited fetching of allmenus.com pages
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import threading
+import requests
+import profiling
+from time import sleep, monotonic
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+
+CONCURRENCY = 4
+# one request every 4 seconds, the pace of the original sleep(4) between
+# pages. Raise it explicitly (Scraper(rate=...)) to scrape faster
+RATE = 0.25
+BURST = 1
+TIMEOUT = 30
+
+
+class RateLimiter():
+    '''
+    class storing a token bucket shared by every thread of a Fetcher
+    '''
+
+    def __init__(self, rate=RATE, burst=BURST):
+        '''
+        Constructor for the RateLimiter class
+
+        Input:
+          rate (float): number of tokens (requests) added per second
+          burst (int): maximum number of tokens the bucket can hold
+        '''
+
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        '''
+        Take one token from the bucket, sleeping until one is available
+        '''
+
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class Fetcher():
+    '''
+    class storing a pooled keep-alive session, a rate limiter and the number
+    of requests allowed in flight
+    '''
+
+    def __init__(self, concurrency=CONCURRENCY, rate=RATE, burst=BURST,
+                 timeout=TIMEOUT, cache=None):
+        '''
+        Constructor for the Fetcher class
+
+        Input:
+          concurrency (int): the number of requests kept in flight
+          rate (float): the requests-per-second budget for the host
+          burst (int): the number of requests that can be sent at once after
+                       an idle period
+          timeout (float): seconds to wait for a response
+          cache (ResponseCache): cache to read responses from and write them
+                                 to. If None, every request goes out
+        '''
+
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.cache = cache
+        self.limiter = RateLimiter(rate, burst)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+
+    def __repr__(self):
+        '''
+        Representation for the Fetcher class
+        '''
+
+        return ('Fetcher with {} requests in flight at {} requests per ' +
+                'second').format(self.concurrency, self.limiter.rate)
+
+
+    def get(self, url, **kwargs):
+        '''
+        Send a GET request through the shared session once the rate limiter
+        allows it. If there is a cache, a fresh cached response is returned
+        without any request and a stale one is revalidated with its ETag or
+        Last-Modified header.
+
+        Input:
+          url (str): the url to request
+
+        Return:
+          (requests.Response or CachedResponse) the response for the url
+        '''
+
+        kwargs.setdefault('timeout', self.timeout)
+        if self.cache is None:
+            return self.send(url, **kwargs)
+        cached, fresh, headers = self.cache.lookup(url)
+        if fresh:
+            profiling.add('http_cache.hits')
+            return cached
+        headers.update(kwargs.pop('headers', {}))
+        rqst = self.send(url, headers=headers, **kwargs)
+        if rqst.status_code == 304 and cached is not None:
+            profiling.add('http_cache.hits')
+            profiling.add('http_cache.revalidated')
+            self.cache.touch(url)
+            return cached
+        profiling.add('http_cache.misses')
+        self.cache.store(url, rqst)
+        return rqst
+
+
+    def send(self, url, **kwargs):
+        '''
+        Send a GET request through the shared session once the rate limiter
+        allows it, counting the request and the time spent waiting for the
+        limiter and on the network (see profiling.py)
+
+        Input:
+          url (str): the url to request
+
+        Return:
+          (requests.Response) the response for the url
+        '''
+
+        with profiling.timer('fetch.wait_seconds'):
+            self.limiter.acquire()
+        with profiling.timer('fetch.network_seconds'):
+            rqst = self.session.get(url, **kwargs)
+        profiling.add('fetch.requests')
+        return rqst
+
+
+    def map(self, func, items):
+        '''
+        Apply func to every item with up to self.concurrency calls running at
+        the same time. func is expected to do its requests with self.get.
+
+        Input:
+          func (function): function taking a single item
+          items (iterable): items to apply func to
+
+        Return:
+          (list) the results of func, in the same order as items
+        '''
+
+        return list(self.imap(func, items))
+
+
+    def imap(self, func, items):
+        '''
+        Like map, but yield the results one at a time, in the same order as
+        items, so the caller can handle each result as soon as it is ready
+        instead of holding all of them
+
+        Input:
+          func (function): function taking a single item
+          items (iterable): items to apply func to
+
+        Return:
+          (generator) the results of func
+        '''
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for result in executor.map(func, items):
+                yield result
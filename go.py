@@ -4,13 +4,14 @@ Execute entire data collection and processing
 Nak Won Rim, Anqi Hu, Chia-yun Chang
 '''
 
-import scraper
-import tract_income
-import inspection
-import count_crime
-import pandas as pd
+import sys
+import pipeline
+import profiling
+from cache import TRACT_CACHE_PATH
+from scraper import REFRESH
+from fetcher import RATE
 
-def go():
+def go(force=(), profile=False, dump=False, rate=RATE):
     '''
     The final scraping and data processing function. Scrapes all cuisines from
     all available restaurants in Chicago from allmenus.com, add the census
@@ -18,24 +19,46 @@ def go():
     inspection result of restaurant and the number of crimes that happened
     within 0.8 kms of restaurant.
     Creates 'final.pkl', which is a final pickle file that contains all data.
-    Also creates 'data/scrape_final.pkl', which is the pickle file containing
-    only the results from scraping. Note that this was a safe measure and it
-    is not included in the final repository.
+    The result of every stage is kept in 'data/pipeline/' (see pipeline.py),
+    so a rerun only redoes the stages whose inputs or parameters changed,
+    e.g. changing the crime radius only recounts the crimes. Pass the names
+    of stages in force to redo them anyway (python go.py scrape).
+    The scraped restaurants are also kept in 'data/scrape_final.pkl'. Once
+    it exists, rerunning the scrape stage (python go.py scrape) refreshes
+    that dataset instead of scraping everything again: only new restaurants
+    and the REFRESH restaurants scraped the longest time ago are fetched,
+    and unlisted restaurants are dropped (see Scraper.refresh). Every
+    restaurant keeps the time it was scraped in its Scraped_At column.
+    Delete 'data/scrape_final.pkl' to scrape everything again.
+    The scraper sends at most rate requests per second to allmenus.com, one
+    every 4 seconds by default. Raise it (python go.py --rate=1) to scrape
+    faster; the budget does not change the results, so the scrape stage is
+    not rerun for it.
+    Responses are cached in 'data/http_cache.sqlite' and every scraped
+    restaurant is recorded in 'data/scrape_journal.ndjson', so rerunning go()
+    after an interruption picks up from the last restaurant it finished.
+    The journal is deleted once the scrape completes.
+    Census tracts are found offline from the restaurant coordinates. Only
+    restaurants outside every tract polygon are geocoded, and those tracts
+    are cached in 'data/tract_cache.sqlite'.
+    With profile (python go.py --profile), the wall time, network and
+    parsing time, request counts, cache hit rates, rows per second and peak
+    memory of every stage are written to 'data/profile.json'. With dump
+    (python go.py --dump), every stage is also run under cProfile, one stage
+    at a time, and its stats are written to 'data/profile/<stage>.prof'.
     '''
 
-    sc = scraper.Scraper()
-    sc.add_all_cuisines()
-    sc.get_url_set()
-    df = sc.scrape_menus()
-    df.to_pickle('data/scrape_final.pkl')
-    df['Tract'] = df['Address'].apply(tract_income.get_tract)
-    df['Income'] = df['Tract'].apply(tract_income.get_income)
-    df['Inspection'] = df.apply(inspection.get_inspection, axis=1)
-    df2 = pd.DataFrame(df['Coordinate'].apply(count_crime.count_crimes))
-    df = pd.merge(df, df2, left_index=True, right_index=True)
-    df.columns = [c.title() for c in df.columns]
-    df.drop(columns=['Address', 'Cuisine'], inplace=True)
-    df.to_pickle('final.pkl')
+    pipe = pipeline.build(refresh=REFRESH, path=pipeline.SCRAPE_PATH,
+                          rate=rate, tract_cache=TRACT_CACHE_PATH)
+    if dump:
+        pipe.workers = 1
+    with profiling.profiled(profile, dump):
+        results = pipe.run(force)
+    results['final'].to_pickle('final.pkl')
 
 if __name__ == "__main__":
-    go()
\ No newline at end of file
+    args = sys.argv[1:]
+    rates = [float(a[len('--rate='):]) for a in args
+             if a.startswith('--rate=')]
+    go([a for a in args if not a.startswith('--')], '--profile' in args,
+       '--dump' in args, rates[-1] if rates else RATE)
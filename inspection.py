@@ -4,10 +4,21 @@ Getting The most recent inspection data of restaurants
 Nak Won Rim, Anqi Hu, Chia-yun Chang
 '''
 
+import sys
 import jellyfish
+import numpy as np
 import pandas as pd
+import datasets
+import enrich
+from address import block_key
+from functools import partial
 
-INSPECTION = pd.read_csv('data/Inspection.csv')
+INSPECTION_PATH = 'data/Inspection.csv'
+NAME_COL, ADDRESS_COL, DATE_COL, RESULT_COL = 0, 2, 3, 4
+THRESHOLD = 0.667
+BOOST_THRESHOLD, MAX_BOOST = 0.7, 0.4
+EPSILON = 1e-9
+INDEX = None
 
 def jw(string1, string2):
     '''
@@ -24,27 +35,268 @@ def jw(string1, string2):
     return jellyfish.jaro_winkler(string1, string2)
 
 
-def get_inspection(row):
+def normalize_name(name):
+    '''
+    Normalize an establishment or restaurant name for matching: lowercase
+    it and intern it, so that every occurrence of a name is the same string
+    object and hashes and compares quickly as a cache key
+
+    Inputs:
+        name(str): the name
+
+    Outputs:
+        (str) the normalized name
+    '''
+
+    return sys.intern(name.lower())
+
+
+def score_bounds(length, lengths):
+    '''
+    Upper bounds of the Jaro-Winkler similarity between a string of a given
+    length and strings of other lengths. At most as many characters as the
+    shorter string has can match, which bounds the Jaro similarity by
+    (2 + shorter / longer) / 3, and the prefix bonus adds at most
+    MAX_BOOST of what is left once the Jaro similarity passes
+    BOOST_THRESHOLD.
+
+    Inputs:
+        length(int): the length of the string
+        lengths(numpy array): the lengths of the other strings
+
+    Outputs:
+        (numpy array) the bounds, 0 for an empty string
+    '''
+
+    shorter = np.minimum(length, lengths)
+    longer = np.maximum(np.maximum(length, lengths), 1)
+    jaro = np.where(shorter > 0, (2 + shorter / longer) / 3, 0)
+    return np.where(jaro > BOOST_THRESHOLD, jaro + MAX_BOOST * (1 - jaro),
+                    jaro)
+
+
+def best_match(name, names, lengths, threshold=THRESHOLD, cache=None):
+    '''
+    Score a name against a whole block of names in one call and find the
+    most similar one. The names are tried from the highest bound of their
+    score (see score_bounds) down, and the search stops at the first name
+    that cannot beat the best score so far. Ties go to the earliest name of
+    the block, like scoring the names in order.
+
+    Inputs:
+        name(str): the normalized name to match (see normalize_name)
+        names(list of str): the normalized names of the block
+        lengths(numpy array): the lengths of names
+        threshold(float): a match needs a Jaro-Winkler score above this
+        cache(dict): scores of pairs of names already scored, filled as
+            pairs are scored (optional)
+
+    Outputs:
+        (tuple) the position in names of the best match and its score, or
+        (None, threshold) if no name scored above the threshold
+    '''
+
+    bounds = score_bounds(len(name), lengths)
+    best, match = threshold, None
+    for i in np.argsort(-bounds, kind='mergesort'):
+        if bounds[i] + EPSILON < best:
+            break
+        if cache is None:
+            score = jw(name, names[i])
+        else:
+            key = (name, names[i])
+            score = cache.get(key)
+            if score is None:
+                score = cache[key] = jw(name, names[i])
+        if score > best or (score == best and match is not None and
+                            i < match):
+            best, match = score, i
+    return match, best
+
+
+def collapse_latest(raw):
+    '''
+    Collapse the inspection table to the latest inspection of every
+    establishment. An establishment is a name and an address, compared
+    without case and surrounding spaces.
+
+    Inputs:
+        raw(pandas dataframe): the inspection table as read from
+            data/Inspection.csv
+
+    Outputs:
+        latest(pandas dataframe): one row per establishment with the columns
+            Name, Address, Date and Result, in the order the establishments
+            first appear in raw
+    '''
+
+    latest = pd.DataFrame({'Name': raw.iloc[:, NAME_COL],
+                           'Address': raw.iloc[:, ADDRESS_COL],
+                           'Date': pd.to_datetime(raw.iloc[:, DATE_COL],
+                                                  errors='coerce'),
+                           'Result': raw.iloc[:, RESULT_COL]},
+                          columns=['Name', 'Address', 'Date', 'Result'])
+    latest = latest[latest['Name'].apply(isinstance, args=(str,)) &
+                    latest['Address'].apply(isinstance, args=(str,))]
+    key = [latest['Name'].str.strip().str.lower(),
+           latest['Address'].str.strip().str.upper()]
+    latest = latest.assign(Group=latest.groupby(key, sort=False).ngroup())
+    latest = latest.sort_values('Date', kind='mergesort', na_position='first')
+    latest = latest.drop_duplicates('Group', keep='last')
+    latest = latest.sort_values('Group').drop(columns='Group')
+    return latest.reset_index(drop=True)
+
+
+def read_latest(path):
+    '''
+    Read the inspection csv, keeping only the columns up to the result, and
+    collapse it to the latest inspection of every establishment
+
+    Inputs:
+        path(str): the csv file of all inspections
+
+    Outputs:
+        (pandas dataframe) the table built by collapse_latest
+    '''
+
+    return collapse_latest(pd.read_csv(path,
+                                       usecols=range(RESULT_COL + 1)))
+
+
+datasets.register('inspection', INSPECTION_PATH, read_latest)
+
+
+def build_index(inspection):
+    '''
+    Group the inspections by the street number, direction and street name
+    of their address (see address.block_key), which is the block a
+    restaurant is compared with. An address without a direction cannot tell
+    North from South, so the block of a street without the direction holds
+    the inspections of every direction, and the block of a direction also
+    holds the inspections that have none.
+
+    Inputs:
+        inspection(pandas dataframe): the table built by collapse_latest
+
+    Outputs:
+        blocks(dict): maps a block key to a tuple (names, lengths,
+            results) of the normalized establishment names (see
+            normalize_name), their lengths and the inspection results in
+            that block, in table order
+    '''
+
+    members = {}
+    plain = {}
+    streets = {}
+    for i, address in enumerate(inspection['Address']):
+        key, loose = block_key(address), block_key(address, False)
+        members.setdefault(key, []).append(i)
+        if key != loose:
+            members.setdefault(loose, []).append(i)
+            streets[key] = loose
+        else:
+            plain.setdefault(loose, []).append(i)
+    for key, loose in streets.items():
+        if loose in plain:
+            members[key] = sorted(members[key] + plain[loose])
+    names = [normalize_name(name) for name in inspection['Name']]
+    lengths = np.array([len(n) for n in names], dtype='int64')
+    results = list(inspection['Result'])
+    return {key: ([names[i] for i in rows], lengths[rows],
+                  [results[i] for i in rows])
+            for key, rows in members.items()}
+
+
+def get_index():
+    '''
+    Get the blocking index of the latest inspections, building it on the
+    first call
+
+    Outputs:
+        (dict) the blocks built by build_index
+    '''
+
+    global INDEX
+    if INDEX is None:
+        INDEX = build_index(datasets.load('inspection'))
+    return INDEX
+
+
+def match_inspection(restaurant, address, threshold=THRESHOLD,
+                     blocks=None, cache=None):
+    '''
+    Find the inspection whose establishment name is the most similar to the
+    restaurant name, among the inspections in the same address block
+
+    Inputs:
+        restaurant(str): the name of the restaurant
+        address(str): the street address of the restaurant
+        threshold(float): a match needs a Jaro-Winkler score above this
+        blocks(dict): the blocking index (defaults to the index of the
+            latest inspections)
+        cache(dict): scores of the pairs of names already scored (see
+            best_match, optional)
+
+    Outputs:
+        (tuple) the inspection result and the score of the match, or
+        (None, NaN) if no name scored above the threshold
+    '''
+
+    if blocks is None:
+        blocks = get_index()
+    names, lengths, results = blocks.get(block_key(address),
+                                         ((), np.zeros(0), ()))
+    match, score = best_match(normalize_name(restaurant), names, lengths,
+                              threshold, cache)
+    if match is None:
+        return None, np.nan
+    return results[match], score
+
+
+def get_inspection(row, threshold=THRESHOLD):
     '''
     Obtains the latest food safety inspection result for a restaurant
 
     Inputs:
         row: a row of restaurant-related information 
+        threshold(float): a match needs a Jaro-Winkler score above this
 
     Outputs:
         Matched inspection results if the restaurant information was found.
         Otherwise, return None.
 
     '''
-    first4 = row['Address'][:4]
-    high_jw = 0.667
-    match = ''
-    for entry in INSPECTION.itertuples(index=False):
-        if entry[2][:4] == first4:
-            new_jw = jw(row['Restaurant'].lower(), entry[0].lower())
-            if new_jw > high_jw:
-                high_jw = new_jw
-                match = entry
-    if not match:
-        return None
-    return match[4]
\ No newline at end of file
+
+    return match_inspection(row['Restaurant'], row['Address'], threshold)[0]
+
+
+def get_inspections(df, threshold=THRESHOLD, processes=1):
+    '''
+    Obtains the inspection result and the match score for every restaurant,
+    using the blocking index built once for all of them. The scores of
+    pairs of names are cached across the restaurants, since chains and
+    repeated listings score the same pairs again.
+
+    Inputs:
+        df(pandas dataframe): restaurants with Restaurant and Address columns
+        threshold(float): a match needs a Jaro-Winkler score above this
+        processes(int): the number of worker processes the restaurants are
+            split across
+
+    Outputs:
+        (pandas dataframe) the Inspection result and the Score of the match
+        of every restaurant, indexed like df
+    '''
+
+    blocks = get_index()
+    if processes > 1:
+        return pd.concat(enrich.run_chunks(
+            partial(get_inspections, threshold=threshold),
+            df[['Restaurant', 'Address']], processes, [get_index]))
+    cache = {}
+    matches = [match_inspection(restaurant, address, threshold, blocks,
+                                cache)
+               for restaurant, address in zip(df['Restaurant'],
+                                              df['Address'])]
+    return pd.DataFrame(matches, index=df.index,
+                        columns=['Inspection', 'Score'])
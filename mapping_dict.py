@@ -8,11 +8,19 @@ import requests
 import re
 import pickle
 from bs4 import BeautifulSoup
-from time import sleep
+from functools import lru_cache
 from collections import Counter 
 
 
 CORE_URL = 'https://www.allmenus.com/il/chicago/-/'
+DROP_RE = re.compile(r"[/\s\)]")
+DASH_RE = re.compile(r'&amp;|[\(&]')
+ALIASES = {'delifood': 'deli',
+           'eclectic-international': 'eclectic',
+           'noodles': 'noodle-bar',
+           'potatoes': 'potato',
+           'subs': 'sub'}
+CACHE_SIZE = 4096
 
 def get_all_cusines(CORE_URL):
     '''
@@ -34,9 +42,11 @@ def get_all_cusines(CORE_URL):
     return cuisine_set
 
 
+@lru_cache(maxsize=CACHE_SIZE)
 def clean_cuisine_name(cuisine):
     '''
-    Clean the cuisine name to standardize
+    Clean the cuisine name to standardize. There are only a few hundred
+    distinct cuisine names, so the results are memoized.
 
     Input:
       cuisine (str): the cuisine name to be standardized
@@ -45,56 +55,47 @@ def clean_cuisine_name(cuisine):
       cuisine (str): the standardized cuisine name
     '''
 
-    cuisine = re.sub("[/\s\)]", "", cuisine.strip().lower())
-    cuisine = re.sub('&amp;|[\(&]', "-", cuisine)
-    if cuisine == "delifood":
-        cuisine = "deli"
-    elif cuisine == "eclectic-international":
-        cuisine = "eclectic"
-    elif cuisine == "noodles":
-        cuisine = "noodle-bar"
-    elif cuisine == "potatoes":
-        cuisine = "potato"
-    elif cuisine == "subs":
-        cuisine = "sub"
-    return cuisine
-
-
-def get_num_rest_and_combi(cuisine_set, CORE_URL):
+    cuisine = DROP_RE.sub("", cuisine.strip().lower())
+    cuisine = DASH_RE.sub("-", cuisine)
+    return ALIASES.get(cuisine, cuisine)
+
+
+def get_num_rest_and_combi(cuisine_set, CORE_URL, sc=None):
     '''
     Extract the number of restaurant for all the cuisine categories in the
-    cuisine_set and store it in a dictionary
+    cuisine_set and store it in a dictionary. The counts and combinations
+    come from the listings read by Scraper.get_url_set, so the listing pages
+    are only fetched once. Every restaurant list item counts, whether it
+    links to a menu or not, on every page of a paginated listing.
 
     Input:
       cusine_set (set): a set containing all cusine categories for all
                         restaruant in Chicago registered in allmenus.com
       CORE_URL (str): the url for the allmenu.com Chicago directory
+      sc (Scraper): a scraper whose get_url_set already ran over the
+                    cuisines. If None, a new scraper fetches the listings
 
     Returns: 
       num_rest (dict): dictionary containing the number of restaurant for
-                       cuisine categories
-      cui_combi (list of list): a list of lists of unique cusine combinations
+                       cuisine categories, sorted by cuisine
+      cui_combi (list of list): a sorted list of lists of unique cusine
+                                combinations
                                 ex) [[american, chicagogrill], [italian]]
     '''
 
-    num_rest = {}
-    cui_combi = []
-    for cuisine in cuisine_set:
-        sleep(4)
-        rqst = requests.get(CORE_URL + cuisine)
-        if rqst.status_code != 200:
-            print(cuisine, "is not a valid cuisine")
-            continue
-        soup = BeautifulSoup(rqst.text, "html.parser")
-        num = len(soup.find_all("li", class_="restaurant-list-item"))
-        for cuisine_com in soup.find_all('p', class_='cousine-list'):
-            if cuisine_com not in cui_combi:
-                combi = cuisine_com.text.split(', ')
-                if combi not in cui_combi:
-                    cui_combi.append(combi)
-        if num == 0:
-            continue
-        num_rest[cuisine] = num
+    if sc is None:
+        # imported here since scraper imports this module
+        from scraper import Scraper
+        sc = Scraper()
+        sc.core_url = CORE_URL
+        sc.cuisine_set = set(cuisine_set)
+        sc.get_url_set()
+    # the listings are read by several threads, so their order changes from
+    # run to run
+    num_rest = {cuisine: num for cuisine, num in
+                sorted(sc.listing_counts.items())
+                if num and cuisine in cuisine_set}
+    cui_combi = sorted(list(combi) for combi in sc.listing_combis)
     return num_rest, cui_combi
 
 
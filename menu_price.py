@@ -0,0 +1,199 @@
+'''
+Batch aggregation of menu item prices into section means and restaurant
+medians
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import numpy as np
+import pandas as pd
+
+
+def flatten_menu(restaurant_json):
+    '''
+    Collect the raw price of every menu item of a restaurant together with
+    the position of its menu section. Items without a price are skipped and
+    a malformed section stops the walk, like the per-section loop did.
+
+    Input:
+      restaurant_json (dict): the ld+json data of a restaurant page
+
+    Returns:
+      menu (list of lists): [section number, raw price] for every item
+    '''
+
+    menu = []
+    try:
+        menu_sections = restaurant_json["hasMenu"][0]["hasMenuSection"]
+        for sec_no, section in enumerate(menu_sections):
+            for item in section.get("hasMenuItem", []):
+                try:
+                    price = item["offers"][-1]["Price"]
+                except:
+                    continue
+                if isinstance(price, (str, int, float)):
+                    menu.append([sec_no, price])
+    except:
+        pass
+    return menu
+
+
+def build_item_table(menus):
+    '''
+    Flatten the menus of many restaurants into one columnar table of items
+
+    Input:
+      menus (dict or pandas Series): the flattened menu (see flatten_menu)
+                                     of each restaurant, keyed by restaurant id
+
+    Returns:
+      (pandas dataframe) one row per priced item with the columns Id,
+      Section and Price, in menu order
+    '''
+
+    ids, sections, raw = [], [], []
+    for key, menu in menus.items():
+        ids.extend([key] * len(menu))
+        for sec_no, price in menu:
+            sections.append(sec_no)
+            raw.append(price)
+    prices, valid = to_prices(raw)
+    return pd.DataFrame({'Id': ids, 'Section': sections,
+                         'Price': prices})[valid]
+
+
+def to_prices(raw):
+    '''
+    Convert raw prices to floats. The common case is converted at once with
+    pandas and only values pandas could not read are retried with float(), so
+    the result is the same as calling float() on every value.
+
+    Input:
+      raw (list): raw prices (str, int or float)
+
+    Returns:
+      (tuple) (prices, valid), a float64 array and a boolean array marking
+      the prices float() could read
+    '''
+
+    raw = pd.Series(raw, dtype=object)
+    prices = pd.to_numeric(raw, errors='coerce').to_numpy(dtype='float64',
+                                                          copy=True)
+    valid = ~np.isnan(prices)
+    for i in np.flatnonzero(~valid):
+        try:
+            prices[i] = float(raw.iat[i])
+            valid[i] = True
+        except:
+            pass
+    return prices, valid
+
+
+def group_starts(keys):
+    '''
+    Find where each run of equal keys starts in a sorted array
+
+    Input:
+      keys (numpy array): sorted keys
+
+    Returns:
+      (numpy array) the index of the first element of every run
+    '''
+
+    if not len(keys):
+        return np.array([], dtype='int64')
+    return np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+
+def row_sums(values, starts, lengths):
+    '''
+    Sum consecutive runs of values. Runs of the same length are summed as
+    the rows of one matrix, which keeps numpy's pairwise summation and gives
+    the same result as calling np.sum on each run.
+
+    Input:
+      values (numpy array): the values to sum
+      starts (numpy array): the start index of every run
+      lengths (numpy array): the length of every run
+
+    Returns:
+      (numpy array) the sum of every run
+    '''
+
+    sums = np.empty(len(starts))
+    for length in np.unique(lengths):
+        runs = np.flatnonzero(lengths == length)
+        sums[runs] = values[starts[runs, None] +
+                            np.arange(length)].sum(axis=1)
+    return sums
+
+
+def aggregate_prices(items):
+    '''
+    Compute the mean price of every menu section and the median of the
+    section means of every restaurant in one pass over the item table.
+    Sections whose mean is 0 are left out, and restaurants with no section
+    left are dropped. Also returns the 25th/75th percentile of the section
+    means, the highest item price and the number of priced items and
+    sections.
+
+    Input:
+      items (pandas dataframe): the item table built by build_item_table
+
+    Returns:
+      (pandas dataframe) indexed by restaurant id with the columns Price,
+      P25, P75, Max, Items and Sections
+    '''
+
+    columns = ['Price', 'P25', 'P75', 'Max', 'Items', 'Sections']
+    if not len(items):
+        return pd.DataFrame(columns=columns, index=pd.Index([], name='Id'))
+    rest_ids, rest_codes = np.unique(items['Id'].to_numpy(),
+                                     return_inverse=True)
+    section = items['Section'].to_numpy()
+    price = items['Price'].to_numpy(dtype='float64')
+    order = np.lexsort((section, rest_codes))
+    rest_codes, section = rest_codes[order], section[order]
+    price = price[order]
+
+    # restaurant level item statistics
+    item_starts = group_starts(rest_codes)
+    n_items = np.diff(np.r_[item_starts, len(price)])
+    max_price = np.maximum.reduceat(price, item_starts)
+
+    # section means
+    new_sec = ((rest_codes[1:] != rest_codes[:-1]) |
+               (section[1:] != section[:-1]))
+    sec_starts = np.flatnonzero(np.r_[True, new_sec])
+    sec_lengths = np.diff(np.r_[sec_starts, len(price)])
+    means = row_sums(price, sec_starts, sec_lengths) / sec_lengths
+    sec_rest = rest_codes[sec_starts]
+    keep = means != 0
+    means, sec_rest = means[keep], sec_rest[keep]
+
+    # medians and quartiles of the section means
+    order = np.lexsort((means, sec_rest))
+    means, sec_rest = means[order], sec_rest[order]
+    starts = group_starts(sec_rest)
+    n_sec = np.diff(np.r_[starts, len(means)])
+    rest = sec_rest[starts]
+    has_nan = np.zeros(len(rest_ids), dtype=bool)
+    has_nan[sec_rest[np.isnan(means)]] = True
+    has_nan = has_nan[rest]
+    stats = {}
+    for name, q in [('P25', 0.25), ('Price', 0.5), ('P75', 0.75)]:
+        pos = q * (n_sec - 1)
+        low = np.floor(pos).astype('int64')
+        high = np.ceil(pos).astype('int64')
+        a, b = means[starts + low], means[starts + high]
+        if q == 0.5:
+            stat = np.where(low == high, a, (a + b) / 2)
+        else:
+            stat = a + (b - a) * (pos - low)
+        stat[has_nan] = np.nan
+        stats[name] = stat
+    stats['Max'] = max_price[rest]
+    stats['Items'] = n_items[rest]
+    stats['Sections'] = n_sec
+    return pd.DataFrame(stats, index=pd.Index(rest_ids[rest], name='Id'),
+                        columns=columns)
@@ -0,0 +1,435 @@
+'''
+A small pipeline runner for the data collection. Each stage declares the
+stages it takes as inputs, its parameters and the source files it reads. The
+result of a stage is pickled under a hash of all of these, so a stage only
+reruns when one of them changed, and stages that do not depend on each other
+run at the same time.
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import os
+import json
+import pickle
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
+import scraper
+import fetcher
+import tract_income
+import inspection
+import count_crime
+import enrich
+import profiling
+from cache import ResponseCache, Journal, KeyValueStore
+
+
+PIPELINE_DIR = 'data/pipeline'
+SCRAPE_PATH = 'data/scrape_final.pkl'
+WORKERS = 4
+
+
+class Stage():
+    '''
+    class storing one stage of a pipeline
+    '''
+
+    def __init__(self, name, func, inputs=(), params=None, sources=(),
+                 options=None):
+        '''
+        Constructor for the Stage class
+
+        Input:
+          name (str): the name of the stage
+          func (function): called as func(*input results, **params)
+          inputs (list of str): the names of the stages whose results func
+                                takes, in order
+          params (dict): keyword arguments of func. They must be json
+                         serializable, since they are part of the hash
+          sources (list of str): files read by func. A stage reruns when
+                                 one of them is modified
+          options (dict): keyword arguments of func that do not change its
+                          result (e.g. the number of processes), left out of
+                          the hash
+        '''
+
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params or {}
+        self.sources = list(sources)
+        self.options = options or {}
+
+
+    def key(self, input_digests):
+        '''
+        Hash the things the result of the stage depends on
+
+        Input:
+          input_digests (list of str): the digests of the input results
+
+        Returns:
+          (str) a hex digest
+        '''
+
+        mtimes = [os.path.getmtime(path) if os.path.exists(path) else None
+                  for path in self.sources]
+        spec = json.dumps([self.name, self.params, self.sources, mtimes,
+                           input_digests], sort_keys=True, default=str)
+        return hashlib.sha256(spec.encode()).hexdigest()
+
+
+class Pipeline():
+    '''
+    class storing a pipeline of stages and the directory their results are
+    kept in
+    '''
+
+    def __init__(self, stages, directory=PIPELINE_DIR, workers=WORKERS,
+                 processes=1):
+        '''
+        Constructor for the Pipeline class
+
+        Input:
+          stages (list of Stage): the stages. A stage may only take the
+                                  stages listed before it as inputs
+          directory (str): the directory the stage results are kept in
+          workers (int): the number of stages run at the same time
+          processes (int): the number of worker processes shared by the
+                           stages that run on a pool (see enrich.py)
+        '''
+
+        self.stages = {}
+        for stage in stages:
+            for name in stage.inputs:
+                if name not in self.stages:
+                    raise ValueError('stage {} takes {}, which is not an '
+                                     'earlier stage'.format(stage.name, name))
+            self.stages[stage.name] = stage
+        self.directory = directory
+        self.workers = workers
+        self.processes = processes
+
+
+    def path(self, stage, key):
+        '''
+        Get the file the result of a stage is kept in
+
+        Input:
+          stage (Stage): the stage
+          key (str): the hash of the stage (see Stage.key)
+
+        Returns:
+          (str) the path of the pickle file
+        '''
+
+        return os.path.join(self.directory,
+                            '{}-{}.pkl'.format(stage.name, key[:16]))
+
+
+    def run_stage(self, stage, results, digests, force):
+        '''
+        Get the result of a stage, from its file if it has one for the
+        current inputs, or by running it. Either way the stage is recorded
+        if the run is profiled (see profiling.py).
+
+        Input:
+          stage (Stage): the stage
+          results (dict): the results of the finished stages
+          digests (dict): the digests of the finished stages' results
+          force (bool): if True, run the stage even if it has a result
+
+        Returns:
+          (tuple) (result, digest, ran), where digest is the hash of the
+          pickled result and ran is False if the result was read from disk
+        '''
+
+        path = self.path(stage, stage.key([digests[n] for n in stage.inputs]))
+        with profiling.stage(stage.name) as record:
+            record['cached'] = not force and os.path.exists(path)
+            if record['cached']:
+                with open(path, 'rb') as pkl:
+                    data = pkl.read()
+                result = pickle.loads(data)
+            else:
+                result = stage.func(*[results[n] for n in stage.inputs],
+                                    **stage.params, **stage.options)
+            record['rows'] = len(result) if hasattr(result, '__len__') \
+                else None
+        if record['cached']:
+            return result, hashlib.sha256(data).hexdigest(), False
+        data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as pkl:
+            pkl.write(data)
+        os.replace(tmp, path)
+        return result, hashlib.sha256(data).hexdigest(), True
+
+
+    def run(self, force=()):
+        '''
+        Run the pipeline. A stage starts as soon as all of its inputs are
+        done. Since a stage is keyed by the digests of its input results, a
+        stage whose inputs were recomputed with the same result is not rerun.
+        The worker processes of the stages are started once, before the
+        stages' threads (see enrich.shared_pool).
+
+        Input:
+          force (list of str): names of stages to rerun even if they have a
+                               result for their inputs
+
+        Returns:
+          (dict) the result of every stage, by name
+        '''
+
+        results, digests = {}, {}
+        pending = list(self.stages.values())
+        running = {}
+        with enrich.shared_pool(self.processes), \
+                ThreadPoolExecutor(self.workers) as executor:
+            while pending or running:
+                for stage in [s for s in pending
+                              if all(n in results for n in s.inputs)]:
+                    pending.remove(stage)
+                    running[executor.submit(self.run_stage, stage, results,
+                                            digests,
+                                            stage.name in force)] = stage
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    result, digest, ran = future.result()
+                    print('{}: {}'.format(stage.name,
+                                          'done' if ran else 'cached'))
+                    results[stage.name] = result
+                    digests[stage.name] = digest
+        return results
+
+
+def scrape(cuisines=None, cached=True, refresh=None, path=None,
+           rows_path=scraper.ROWS_PATH, concurrency=fetcher.CONCURRENCY,
+           rate=fetcher.RATE):
+    '''
+    Scrape the restaurants of allmenus.com, or refresh the restaurants
+    scraped by a previous run (see Scraper.refresh)
+
+    Input:
+      cuisines (list of str): the cuisines to scrape. If None, all cuisines
+      cached (bool): if True, cache the responses and keep a journal of the
+                     scraped restaurants (see cache.py)
+      refresh (int): if not None and path exists, refresh the restaurants
+                     in path, rescraping this many known restaurants. Cached
+                     responses are then always revalidated. A file written
+                     before the restaurants had a Url, Hash and Scraped_At
+                     cannot be refreshed, so everything is scraped again
+      path (str): the pickle file the scraped restaurants are kept in
+                  between runs (optional)
+      rows_path (str): the NDJSON file the scraped rows are written to (see
+                       Scraper.scrape_urls)
+      concurrency (int): the number of requests kept in flight
+      rate (float): the requests-per-second budget for allmenus.com
+
+    Returns:
+      (pandas dataframe) the scraped restaurants. Raises a ValueError
+      instead of overwriting path if no restaurant was scraped
+    '''
+
+    refresh = refresh if path and os.path.exists(path) else None
+    previous = None
+    if refresh is not None:
+        previous = pd.read_pickle(path)
+        missing = [c for c in ['Url', 'Hash', 'Scraped_At']
+                   if c not in previous.columns]
+        if missing:
+            print('scrape: {} has no {}, scraping every restaurant '
+                  'again'.format(path, ', '.join(missing)))
+            refresh = previous = None
+    cache = None
+    if cached:
+        cache = ResponseCache(ttl=0) if refresh is not None else \
+            ResponseCache()
+    sc = scraper.Scraper(concurrency, rate, cache)
+    if cuisines is None:
+        sc.add_all_cuisines()
+    else:
+        for cuisine in cuisines:
+            sc.add_cuisine(cuisine)
+    with profiling.stage('scrape_listing') as record:
+        sc.get_url_set()
+        record['rows'] = len(sc.url_set)
+    with profiling.stage('scrape_menus') as record:
+        if refresh is not None:
+            df = sc.refresh(previous, refresh, rows_path)
+        else:
+            df = sc.scrape_menus(Journal() if cached else None, rows_path)
+        record['rows'] = len(df)
+    if df.empty:
+        raise ValueError('scrape: no restaurant was scraped')
+    if path:
+        df.to_pickle(path)
+    return df
+
+
+def tracts(df, cache_path=None):
+    '''
+    Find the census tract of the restaurants, offline from their coordinates
+    and by geocoding the restaurants outside every tract polygon (all of
+    them if the tract shapefile is missing)
+
+    Input:
+      df (pandas dataframe): the scraped restaurants
+      cache_path (str): the KeyValueStore the geocoded tracts are cached in
+                        (optional)
+
+    Returns:
+      (pandas series) the tract of every restaurant
+    '''
+
+    tract = tract_income.assign_tracts(df['Coordinate'])
+    missing = tract.isna()
+    cache = KeyValueStore(cache_path) if cache_path else None
+    tract.loc[missing] = tract_income.get_tracts(df.loc[missing, 'Address'],
+                                                 cache)
+    return tract.rename('Tract')
+
+
+def incomes(tract, year):
+    '''
+    Find the area median income of the tracts
+
+    Input:
+      tract (pandas series): the tract of every restaurant
+      year (int): the year of the income data
+
+    Returns:
+      (pandas series) the income of every restaurant
+    '''
+
+    return tract_income.get_incomes(tract, year)
+
+
+def inspections(df, threshold, processes=1):
+    '''
+    Find the latest inspection result of the restaurants
+
+    Input:
+      df (pandas dataframe): the scraped restaurants
+      threshold (float): a match needs a Jaro-Winkler score above this
+      processes (int): the number of worker processes
+
+    Returns:
+      (pandas series) the inspection result of every restaurant
+    '''
+
+    return inspection.get_inspections(df, threshold,
+                                     processes)['Inspection']
+
+
+def crimes(df, radius, radii=(), bandwidth=None, processes=1):
+    '''
+    Count the crimes around the restaurants. With more radii or a bandwidth,
+    the counts of every radius and the Gaussian weighted counts are
+    computed in the same pass (see count_crime.count_crimes_profile), and the
+    columns of radius keep the names they have without them.
+
+    Input:
+      df (pandas dataframe): the scraped restaurants
+      radius (float): the radius in km
+      radii (tuple): more radii in km to count the crimes within
+      bandwidth (float): the bandwidth in km of the Gaussian weighted count
+      processes (int): the number of worker processes
+
+    Returns:
+      (pandas dataframe) the crime counts of every restaurant
+    '''
+
+    if not radii and bandwidth is None:
+        return count_crime.count_crimes_batch(df['Coordinate'], radius,
+                                              processes)
+    counts = count_crime.count_crimes_profile(
+        df['Coordinate'], set(radii) | {radius}, bandwidth, processes)
+    return counts.rename(columns={
+        count_crime.column_name(name, radius): name
+        for name in count_crime.crime_types() + ['SUM']})
+
+
+def combine(df, tract, income, inspection, crime):
+    '''
+    Join the results of the stages into the final dataset
+
+    Input:
+      df (pandas dataframe): the scraped restaurants
+      tract, income, inspection (pandas series): results of those stages
+      crime (pandas dataframe): the crime counts
+
+    Returns:
+      (pandas dataframe) the final dataset
+    '''
+
+    df = df.copy()
+    df['Tract'] = tract
+    df['Income'] = income
+    df['Inspection'] = inspection
+    df = pd.merge(df, crime, left_index=True, right_index=True)
+    df.columns = [c.title() for c in df.columns]
+    return df.drop(columns=['Address', 'Cuisine', 'Url', 'Hash',
+                            'Scraped_At'])
+
+
+def build(cuisines=None, cached=True, refresh=None, path=None,
+          rows_path=scraper.ROWS_PATH, concurrency=fetcher.CONCURRENCY,
+          rate=fetcher.RATE, tract_cache=None,
+          threshold=inspection.THRESHOLD, radius=count_crime.RADIUS,
+          year=tract_income.YEAR, radii=(), bandwidth=None,
+          processes=enrich.PROCESSES,
+          directory=PIPELINE_DIR):
+    '''
+    Build the pipeline of the data collection
+
+    Input:
+      cuisines (list of str): the cuisines to scrape. If None, all cuisines
+      cached (bool): if True, cache the scraping responses
+      refresh (int): if not None, refresh the restaurants of the previous
+                     run kept in path instead of scraping them all again
+      path (str): the pickle file the scraped restaurants are kept in
+      rows_path (str): the NDJSON file the scraped rows are written to
+      concurrency (int): the number of scraping requests kept in flight
+      rate (float): the requests-per-second budget of the scraper
+      tract_cache (str): the KeyValueStore geocoded tracts are cached in
+      threshold (float): the inspection match threshold
+      radius (float): the crime radius in km
+      year (int): the year of the income data
+      radii (tuple): more radii in km to count the crimes within
+      bandwidth (float): the bandwidth in km of a Gaussian weighted crime
+                         count (optional)
+      processes (int): the number of worker processes the inspection and
+                       crime stages share (see enrich.py)
+      directory (str): the directory the stage results are kept in
+
+    Returns:
+      (Pipeline) the pipeline, whose last stage is 'final'
+    '''
+
+    return Pipeline([
+        Stage('scrape', scrape,
+              params={'cuisines': cuisines, 'cached': cached,
+                      'refresh': refresh, 'path': path,
+                      'rows_path': rows_path},
+              options={'concurrency': concurrency, 'rate': rate}),
+        Stage('tract', tracts, ['scrape'],
+              params={'cache_path': tract_cache},
+              sources=[tract_income.TRACT_SHAPE_PATH]),
+        Stage('income', incomes, ['tract'], params={'year': year},
+              sources=[tract_income.INCOME_PATH]),
+        Stage('inspection', inspections, ['scrape'],
+              params={'threshold': threshold},
+              sources=[inspection.INSPECTION_PATH],
+              options={'processes': processes}),
+        Stage('crime', crimes, ['scrape'],
+              params={'radius': radius, 'radii': sorted(radii),
+                      'bandwidth': bandwidth},
+              sources=[count_crime.CRIMES_PATH],
+              options={'processes': processes}),
+        Stage('final', combine,
+              ['scrape', 'tract', 'income', 'inspection', 'crime'])],
+        directory, processes=processes)
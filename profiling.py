@@ -0,0 +1,292 @@
+'''
+Timing the stages of the data collection. The scraper, the caches and the
+geocoder count their events (requests, cache hits, ...) and add up the time
+they spend on the network and parsing; while a run is profiled, every stage
+records how these grew during it, with its wall time, the rows it produced
+and its memory, in a json report. The counters are shared by the whole
+process, so the counters of stages that ran at the same time (listed in
+their 'overlapping') include each other's events.
+
+Nak Won Rim, Anqi Hu, Chia-yun Chang
+'''
+
+import os
+import json
+import cProfile
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from time import perf_counter, process_time
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where the peak memory is left out
+    resource = None
+
+
+REPORT_PATH = 'data/profile.json'
+DUMP_DIR = 'data/profile'
+PROFILER = None
+
+
+class Profiler():
+    '''
+    class storing the counters of a profiled run and the records of its
+    stages
+    '''
+
+    def __init__(self, dump_dir=None):
+        '''
+        Constructor for the Profiler class
+
+        Input:
+          dump_dir (str): if given, the stages are also run under cProfile
+                          and their stats are written to this directory
+        '''
+
+        self.counters = {}
+        self.stages = []
+        self.running = []
+        self.dump_dir = dump_dir
+        self.dumping = False
+        self.lock = threading.Lock()
+        self.started = datetime.now()
+        self.start = perf_counter()
+
+
+    def add(self, name, value=1):
+        '''
+        Add to a counter
+
+        Input:
+          name (str): the name of the counter ex) fetch.requests
+          value (float): the amount to add
+        '''
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Record a stage: its wall time, the cpu time of the process, how
+        much every counter grew and how much the resident memory grew. The
+        record is yielded, so the stage can set the number of rows it
+        produced in its 'rows'. The stages other threads ran at the same
+        time are listed in 'overlapping': the cpu time, the counters and
+        the memory are those of the whole process, so they include the
+        work of these stages. Only one stage at a time runs under cProfile
+        (cProfile cannot follow two at once), which follows the thread that
+        entered it.
+
+        Input:
+          name (str): the name of the stage
+        '''
+
+        record = {'stage': name, 'overlapping': []}
+        thread = threading.get_ident()
+        with self.lock:
+            before = dict(self.counters)
+            dump = self.dump_dir is not None and not self.dumping
+            self.dumping = self.dumping or dump
+            # a stage entered by the same thread is nested, not concurrent
+            for other, other_thread in self.running:
+                if other_thread != thread:
+                    other['overlapping'].append(name)
+                    record['overlapping'].append(other['stage'])
+            self.running.append((record, thread))
+        rss = current_rss()
+        profile = cProfile.Profile() if dump else None
+        start, cpu = perf_counter(), process_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield record
+        finally:
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.dump_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(self.dump_dir,
+                                                name + '.prof'))
+                with self.lock:
+                    self.dumping = False
+            elapsed = perf_counter() - start
+            with self.lock:
+                self.running.remove((record, thread))
+                counters = {key: value - before.get(key, 0)
+                            for key, value in self.counters.items()
+                            if value != before.get(key, 0)}
+            record.update({'wall_seconds': elapsed,
+                           'cpu_seconds': process_time() - cpu,
+                           'counters': counters,
+                           'hit_rates': hit_rates(counters)})
+            if record.get('rows') is not None and elapsed > 0:
+                record['rows_per_second'] = record['rows'] / elapsed
+            if rss is not None:
+                record['rss_delta_mb'] = current_rss() - rss
+            record.update(peak_rss())
+            with self.lock:
+                self.stages.append(record)
+
+
+    def report(self):
+        '''
+        Build the report of the run
+
+        Returns:
+          (dict) the start time, the total wall time, the peak memory of
+          the process, the totals of the counters and the record of every
+          stage, in the order the stages finished
+        '''
+
+        with self.lock:
+            report = {'started': self.started.isoformat(),
+                      'wall_seconds': perf_counter() - self.start,
+                      'counters': dict(self.counters),
+                      'hit_rates': hit_rates(self.counters),
+                      'stages': list(self.stages)}
+        report.update(peak_rss())
+        return report
+
+
+def hit_rates(counters):
+    '''
+    Compute the hit rate of every cache with a hits and a misses counter
+
+    Input:
+      counters (dict): counters, ex) {'http_cache.hits': 3,
+                                      'http_cache.misses': 1}
+
+    Returns:
+      (dict) the hit rate by cache ex) {'http_cache': 0.75}
+    '''
+
+    rates = {}
+    for key in counters:
+        if key.endswith('.hits'):
+            cache = key[:-len('.hits')]
+            total = counters[key] + counters.get(cache + '.misses', 0)
+            rates[cache] = counters[key] / total if total else None
+        elif key.endswith('.misses') and \
+                key[:-len('.misses')] + '.hits' not in counters:
+            rates[key[:-len('.misses')]] = 0.0
+    return rates
+
+
+def current_rss():
+    '''
+    Get the resident memory of this process now
+
+    Returns:
+      (float) the resident memory in MB, or None if the platform does not
+      report it (only Linux does, through /proc)
+    '''
+
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+
+def peak_rss():
+    '''
+    Get the peak resident memory of this process so far and of its largest
+    finished child process (the workers of enrich.py). These are high-water
+    marks since the process started, not the memory of a stage.
+
+    Returns:
+      (dict) process_peak_rss_mb and children_peak_rss_mb, empty if the
+      platform does not report them
+    '''
+
+    if resource is None:
+        return {}
+    # ru_maxrss is in kilobytes on Linux
+    return {'process_peak_rss_mb':
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'children_peak_rss_mb':
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss /
+                1024}
+
+
+def add(name, value=1):
+    '''
+    Add to a counter of the profiled run. Does nothing if no run is
+    profiled.
+
+    Input:
+      name (str): the name of the counter ex) fetch.requests
+      value (float): the amount to add
+    '''
+
+    if PROFILER is not None:
+        PROFILER.add(name, value)
+
+
+@contextmanager
+def timer(name):
+    '''
+    Add the time spent in the block to a counter of the profiled run. The
+    time of blocks running in several threads at once adds up, so it can be
+    more than the wall time of the stage.
+
+    Input:
+      name (str): the name of the counter ex) fetch.network_seconds
+    '''
+
+    if PROFILER is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        PROFILER.add(name, perf_counter() - start)
+
+
+@contextmanager
+def stage(name):
+    '''
+    Record a stage of the profiled run (see Profiler.stage). If no run is
+    profiled, only yields a record that is thrown away.
+
+    Input:
+      name (str): the name of the stage
+    '''
+
+    if PROFILER is None:
+        yield {}
+        return
+    with PROFILER.stage(name) as record:
+        yield record
+
+
+@contextmanager
+def profiled(report=True, dump=False, path=REPORT_PATH, dump_dir=DUMP_DIR):
+    '''
+    Profile the run in the block and write its report as json
+
+    Input:
+      report (bool): if False and dump is False, the run is not profiled
+      dump (bool): if True, the stages are also run under cProfile, and
+                   their stats are written to dump_dir as <stage>.prof
+      path (str): the json file of the report
+      dump_dir (str): the directory of the cProfile stats
+    '''
+
+    global PROFILER
+    if not report and not dump:
+        yield
+        return
+    PROFILER = Profiler(dump_dir if dump else None)
+    try:
+        yield
+    finally:
+        profiler, PROFILER = PROFILER, None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(profiler.report(), f, indent=2)
+        print('profile written to', path)
@@ -6,7 +6,104 @@ Nak Won Rim, Anqi Hu, Chia-yun Chang
 
 import pandas as pd
 import numpy as np
-import statsmodels.api as sm
+import scipy.sparse as sp
+from scipy import stats
+
+def design_matrix(x):
+    '''
+    Build the design matrix of the regression as one sparse matrix: a
+    constant, the dense variables and the sparse cuisine dummy variables,
+    which are copied without being densified. Variables that are 0 for every
+    restaurant (a cuisine or a crime type no restaurant has) are left out.
+
+    Input:
+      x (pandas dataframe): the explanatory variables
+
+    Returns:
+      (tuple) (matrix, names), a scipy csc matrix and its column names
+    '''
+
+    sparse = [c for c in x.columns if isinstance(x[c].dtype, pd.SparseDtype)]
+    dense = x.drop(columns=sparse)
+    dense = dense.loc[:, (dense != 0).any()]
+    blocks = [sp.csc_matrix(np.ones((len(x), 1))),
+              sp.csc_matrix(dense.values.astype('float64'))]
+    names = ['const'] + list(dense.columns)
+    for c in sparse:
+        values = x[c].array
+        rows = values.sp_index.to_int_index().indices
+        keep = values.sp_values != 0
+        if not keep.any():
+            continue
+        blocks.append(sp.csc_matrix(
+            (values.sp_values[keep].astype('float64'),
+             (rows[keep], np.zeros(keep.sum(), dtype='int64'))),
+            shape=(len(x), 1)))
+        names.append(c)
+    return sp.hstack(blocks, format='csc'), names
+
+
+def ols(x, y, names):
+    '''
+    Fit an OLS regression on a sparse design matrix through its normal
+    equations. X'X is only p x p, so the n x p design matrix is never
+    densified. Like statsmodels, the pseudo-inverse of X'X is used, so
+    collinear variables (ex) the inspection dummies and the constant) still
+    give a fit.
+
+    Input:
+      x (scipy sparse matrix): the design matrix, with a constant column
+      y (pandas series): the dependent variable
+      names (list of str): the column names of x
+
+    Returns:
+      (tuple) (table, summary), a dataframe of the coefficients with their
+      standard errors, t statistics, p values and 95% confidence intervals,
+      and a dict of the statistics of the fit and of the residuals, the same
+      as in the summary of statsmodels (R-squared, F statistic, AIC,
+      Durbin-Watson, condition number, ...)
+    '''
+
+    y = np.asarray(y, dtype='float64')
+    n = x.shape[0]
+    xtx = x.T.dot(x).toarray()
+    inverse = np.linalg.pinv(xtx)
+    beta = inverse.dot(x.T.dot(y))
+    resid = y - x.dot(beta)
+    rank = np.linalg.matrix_rank(xtx)
+    df_resid, df_model = n - rank, rank - 1
+    rss = resid.dot(resid)
+    tss = ((y - y.mean()) ** 2).sum()
+    sigma2 = rss / df_resid
+    se = np.sqrt(np.diag(inverse) * sigma2)
+    t = beta / se
+    q = stats.t.ppf(0.975, df_resid)
+    table = pd.DataFrame({'coef': beta, 'std err': se, 't': t,
+                          'P>|t|': 2 * stats.t.sf(np.abs(t), df_resid),
+                          '[0.025': beta - q * se, '0.975]': beta + q * se},
+                         index=names)
+    r2 = 1 - rss / tss
+    f = (tss - rss) / df_model / sigma2
+    llf = -n / 2 * (np.log(2 * np.pi) + np.log(rss / n) + 1)
+    skew = stats.skew(resid)
+    kurtosis = stats.kurtosis(resid, fisher=False)
+    jb = n / 6 * (skew ** 2 + (kurtosis - 3) ** 2 / 4)
+    omnibus = stats.normaltest(resid)
+    eigenvalues = np.linalg.eigvalsh(xtx)
+    summary = {'No. Observations': n, 'Df Residuals': df_resid,
+               'Df Model': df_model, 'R-squared': r2,
+               'Adj. R-squared': 1 - (1 - r2) * (n - 1) / df_resid,
+               'F-statistic': f,
+               'Prob (F-statistic)': stats.f.sf(f, df_model, df_resid),
+               'Log-Likelihood': llf, 'AIC': 2 * rank - 2 * llf,
+               'BIC': np.log(n) * rank - 2 * llf,
+               'Omnibus': omnibus[0], 'Prob(Omnibus)': omnibus[1],
+               'Skew': skew, 'Kurtosis': kurtosis, 'Jarque-Bera (JB)': jb,
+               'Prob(JB)': stats.chi2.sf(jb, 2),
+               'Durbin-Watson': (np.diff(resid) ** 2).sum() / rss,
+               'Cond. No.': np.sqrt(eigenvalues.max() / eigenvalues.min())}
+    return table, summary
+
 
 def regression():
     '''
@@ -27,12 +124,12 @@ def regression():
     final.drop(columns=['Tract'], inplace=True)
     final = final.astype({'Price': 'float64'})
     final = final.fillna(0)
-    x = final.drop(columns=['Price'])
-    y = final['Price']
-    x = sm.add_constant(x)
-    lm = sm.OLS(y, x)
-    res = lm.fit()
-    print(res.summary())
+    x, names = design_matrix(final.drop(columns=['Price']))
+    table, summary = ols(x, final['Price'], names)
+    print('OLS Regression Results (dep. variable: Price)')
+    for key, value in summary.items():
+        print('{:<20}{:>14.4g}'.format(key + ':', value))
+    print(table.to_string(float_format='{:.4f}'.format))
 
 if __name__ == "__main__":
     regression()
@@ -4,20 +4,56 @@ Scraping allmenus.com
 Nak Won Rim, Anqi Hu, Chia-yun Chang
 '''
 
+import os
 import requests
 import json
 import pickle
+import hashlib
+import threading
+from collections import Counter
 import numpy as np
 import pandas as pd
+import datasets
+import profiling
 from bs4 import BeautifulSoup
-from time import sleep
-from urllib.parse import urlparse
+from time import time
+from urllib.parse import urlparse, urljoin
 from sklearn.preprocessing import MultiLabelBinarizer
 from mapping_dict import clean_cuisine_name
+from extract import extract_ld_json, extract_listing, extract_next_page
+from menu_price import flatten_menu, build_item_table, aggregate_prices
+from fetcher import Fetcher, CONCURRENCY, RATE
+from cache import RowWriter, iter_ndjson
 
 
-with open('mapping_dict.pkl', 'rb') as pkl:
-    MAPPING_DICT = pickle.load(pkl)
+MAPPING_PATH = 'mapping_dict.pkl'
+ROWS_PATH = 'data/scrape_rows.ndjson'
+ROW_BATCH = 256
+REFRESH = 500
+# a refresh refuses to drop more than half of the previous restaurants
+MIN_LISTED = 0.5
+COLUMNS = ['Cuisine', 'Restaurant', 'Coordinate', 'Address', 'Price', 'Url',
+           'Hash', 'Scraped_At']
+STATS = ['P25', 'P75', 'Max', 'Items', 'Sections']
+
+
+def read_mapping_dict(path):
+    '''
+    Read the pickled cuisine mapping dictionary
+
+    Input:
+      path (str): the pickle file
+
+    Return:
+      (dict) the mapping dictionary
+    '''
+
+    with open(path, 'rb') as pkl:
+        return pickle.load(pkl)
+
+
+datasets.register('mapping_dict', MAPPING_PATH, read_mapping_dict,
+                  cache=False)
 
 
 class Scraper():
@@ -25,14 +61,24 @@ class Scraper():
     class storing scraper
     '''
     
-    def __init__(self):
+    def __init__(self, concurrency=CONCURRENCY, rate=RATE, cache=None):
         '''
         Constructor for the Scraper class
+
+        Input:
+          concurrency (int): the number of requests kept in flight
+          rate (float): the requests-per-second budget for allmenus.com
+          cache (ResponseCache): on-disk response cache shared by every
+                                 request of the scraper (optional)
         '''
 
         self.core_url = 'https://www.allmenus.com/il/chicago/-/'
         self.cuisine_set = set()
         self.url_set = set()
+        self.listing_counts = Counter()
+        self.listing_combis = set()
+        self.price_stats = None
+        self.fetcher = Fetcher(concurrency, rate, cache=cache)
 
 
     def __repr__(self):
@@ -52,7 +98,7 @@ class Scraper():
         add it to the set of cuisines to scrape
         '''
 
-        rqst = requests.get(self.core_url)
+        rqst = self.fetcher.get(self.core_url)
         soup = BeautifulSoup(rqst.text, 'html.parser')
         cusine_container = soup.find('div', class_='cuisine-container')
         for c in cusine_container.find_all('div', class_='s-checkbox-group'):
@@ -73,117 +119,429 @@ class Scraper():
     def get_url_set(self):
         '''
         From each cuisine in the cuisine set, retrieve all the restaurant urls
-        belonging to that cuisine and add it to set of url to scrape.
-        '''
-
-        for cuisine in self.cuisine_set:
-            sleep(4)
-            rqst = requests.get(self.core_url + cuisine)
-            if rqst.status_code != 200:
-                print(cuisine, 'is not a valid cuisine')
-                continue
-            soup = BeautifulSoup(rqst.text, 'html.parser')
-            restaurants = soup.find_all('li', class_='restaurant-list-item')
-            if not restaurants:
-                print(cuisine, 'is not a valid cuisine')
-                continue
-            for r in restaurants:
-                if 'Chicago' not in r.find_all('p', class_='address')[1].text:
-                    continue
-                url = r.find('a', class_=None).get('href')
-                if not urlparse(url).netloc:
-                    url = "https://www.allmenus.com" + url
-                if urlparse(url).netloc != "www.allmenus.com":
-                    continue
-                self.url_set.add(url) 
-
-
-    def scrape_menus(self):
-        '''
-        Scrape all the urls in the set of urls. Write a pickle file to store
-        the final dataframe.
+        belonging to that cuisine and add it to set of url to scrape. The
+        cuisines are fetched concurrently through the fetcher (so within its
+        rate limit), following the next page links of paginated listings.
+        Every restaurant list item is also counted in self.listing_counts
+        (the number of items of each cuisine's listing) and its list of
+        cuisines added to self.listing_combis, whether it has a link and is
+        in Chicago or not.
+        '''
+
+        lock = threading.Lock()
+
+        def discover(cuisine):
+            page, seen = self.core_url + cuisine, set()
+            while page and page not in seen:
+                seen.add(page)
+                rqst = self.fetcher.get(page)
+                restaurants = []
+                if rqst.status_code == 200:
+                    with profiling.timer('parse.seconds'):
+                        restaurants = extract_listing(rqst.text)
+                    profiling.add('parse.listing_pages')
+                if not restaurants:
+                    if len(seen) == 1:
+                        print(cuisine, 'is not a valid cuisine')
+                    return
+                with lock:
+                    self.listing_counts[cuisine] += len(restaurants)
+                    for addresses, url, combi in restaurants:
+                        if combi:
+                            self.listing_combis.add(tuple(combi.split(', ')))
+                        if url is None:
+                            continue
+                        if not urlparse(url).netloc:
+                            url = "https://www.allmenus.com" + url
+                        if urlparse(url).netloc != "www.allmenus.com":
+                            continue
+                        if 'Chicago' in addresses[1]:
+                            self.url_set.add(url)
+                next_page = extract_next_page(rqst.text)
+                page = urljoin(page, next_page) if next_page else None
+
+        self.fetcher.map(discover, sorted(self.cuisine_set))
+
+
+    def scrape_menus(self, journal=None, path=ROWS_PATH):
+        '''
+        Scrape all the urls in the set of urls, keeping the fetcher's number
+        of requests in flight. Write a pickle file to store the final
+        dataframe. The price statistics of every restaurant (see
+        menu_price.aggregate_prices) are kept in self.price_stats.
+
+        Input:
+          journal (Journal): checkpoint journal. Restaurants already recorded
+                             in it (by an interrupted scrape) are not scraped
+                             again and every newly scraped restaurant is
+                             appended to it. It is cleared once every url
+                             is scraped (optional)
+          path (str): the NDJSON file the restaurants are written to (see
+                      scrape_urls)
 
         Return:
           df (pandas dataframe): the pandas dataframe 
         '''
 
-        menus_dict = {}
-        for idx, url in enumerate(self.url_set):
-            sleep(4)
-            scraped = scrape_menu(idx, url)
-            if scraped:
-                menus_dict.update(scraped)
-        df = pd.DataFrame(menus_dict).T
-        mlb = MultiLabelBinarizer()
-        df = pd.concat([df, pd.DataFrame(mlb.fit_transform(df['Cuisine']),
-                                         columns=mlb.classes_, 
-                                         index=df.index)], axis=1)
-        return df
+        df = self.scrape_urls(self.url_set, journal, path)
+        if journal is not None:
+            journal.clear()
+        return add_cuisine_dummies(df)
+
+
+    def refresh(self, previous, n_refresh=REFRESH, path=ROWS_PATH):
+        '''
+        Update the dataframe of a previous run instead of scraping every url
+        again. Scrapes the urls that are new in the set of urls and the
+        n_refresh restaurants that were scraped the longest time ago, so
+        repeated refreshes rotate through all restaurants. A rescraped
+        restaurant whose ld+json payload has the same hash keeps its row and
+        only gets a new Scraped_At. Restaurants whose url is no longer listed
+        are dropped, while a restaurant whose rescrape fails (or finds no
+        usable menu) keeps its previous row. An empty listing, or one
+        missing more than MIN_LISTED of the previous restaurants, is most
+        likely a failed discovery, so it raises instead. The rescraped
+        restaurants are written to a file of their own next to path, and
+        path is then rewritten with the rows of the merged dataframe, so
+        load_rows still rebuilds the whole dataset.
+
+        Input:
+          previous (pandas dataframe): the dataframe of a previous run (see
+                                       scrape_menus)
+          n_refresh (int): the number of known restaurants to rescrape
+          path (str): the NDJSON file of the rows of the previous run
+
+        Return:
+          df (pandas dataframe): the merged dataframe, in the format of
+                                 scrape_menus
+        '''
+
+        if not self.url_set:
+            raise ValueError('refresh: no restaurant is listed, the '
+                             'previous run is left as it is')
+        previous = previous[COLUMNS].copy()
+        listed = previous['Url'].isin(self.url_set)
+        if len(previous) and listed.mean() < MIN_LISTED:
+            raise ValueError('refresh: only {} of the {} previous '
+                             'restaurants are still listed, the previous run '
+                             'is left as it is'.format(listed.sum(),
+                                                       len(previous)))
+        previous = previous[listed].set_index('Url', drop=False)
+        new = sorted(self.url_set - set(previous['Url']))
+        oldest = previous.sort_values('Scraped_At', kind='mergesort')
+        rescrape = list(oldest['Url'][:n_refresh])
+        fresh_path = path + '.refresh'
+        fresh = self.scrape_urls(new + rescrape, path=fresh_path)
+        fresh = fresh.set_index('Url', drop=False)
+        known = fresh.index.isin(previous.index)
+        same = known.copy()
+        same[known] = (fresh['Hash'][known].values ==
+                       previous.loc[fresh.index[known], 'Hash'].values)
+        previous.loc[fresh.index[same], 'Scraped_At'] = \
+            fresh['Scraped_At'][same].values
+        failed = [url for url in rescrape if url not in fresh.index]
+        print('refresh: {} new, {} changed, {} unchanged, {} failed (kept), '
+              '{} removed'.format((~known).sum(), (known & ~same).sum(),
+                                  same.sum(), len(failed), (~listed).sum()))
+        replaced = previous.index.isin(fresh.index[~same])
+        df = pd.concat([previous[~replaced], fresh[~same]])
+        missing = merge_rows(list(df.index), set(fresh.index[~same]),
+                             set(fresh.index[same]), path, fresh_path)
+        if missing:
+            print('refresh: {} restaurants have no row in {}'.format(
+                missing, path))
+        self.price_stats = read_rows(path)[['Price'] + STATS].rename_axis(
+            'Id')
+        return add_cuisine_dummies(df.reset_index(drop=True))
+
+
+    def scrape_urls(self, urls, journal=None, path=ROWS_PATH):
+        '''
+        Scrape the given urls (see scrape_menus), without the cuisine dummy
+        variables. The scraped restaurants are written to the NDJSON file
+        path in batches of ROW_BATCH, whose menus are reduced to price
+        statistics in one pass (see finish_rows), so the scraped restaurants
+        are never all held in memory before the typed table is read back.
+        If the journal has urls recorded by an interrupted scrape, the rows
+        it wrote to path are kept and only the other urls are scraped.
+        Restaurants whose page could not be fetched are not recorded, so a
+        resumed scrape tries them again.
+
+        Input:
+          urls (iterable of str): the restaurant urls to scrape
+          journal (Journal): checkpoint journal (optional)
+          path (str): the NDJSON file the restaurants are written to
+
+        Return:
+          df (pandas dataframe): one row per restaurant with the COLUMNS
+        '''
+
+        def scrape(item):
+            idx, url = item
+            if journal is not None and url in journal:
+                return url, None
+            try:
+                return url, scrape_menu(idx, url, self.fetcher)
+            except requests.RequestException:
+                return url, None
+
+        resume = journal is not None and len(journal) > 0 and \
+            os.path.exists(path)
+        # the restaurants of a resumed scrape keep their ids, so the new
+        # ones are numbered after them
+        start = max_row_id(path) + 1 if resume else 0
+        writer = RowWriter(path, append=resume)
+        rows, done = {}, []
+
+        def flush():
+            for row in finish_rows(rows):
+                writer.write(row)
+            # journaled only once written, so an interruption never loses a
+            # restaurant
+            for url in done:
+                journal.record(url)
+            rows.clear()
+            del done[:]
+
+        for url, scraped in self.fetcher.imap(scrape, enumerate(urls, start)):
+            rows.update(scraped or {})
+            if journal is not None and scraped is not None:
+                done.append(url)
+            if len(rows) >= ROW_BATCH:
+                flush()
+        flush()
+        writer.close()
+        table = read_rows(path)
+        self.price_stats = table[['Price'] + STATS].rename_axis('Id')
+        return table[COLUMNS]
+
+
+def finish_rows(rows):
+    '''
+    Turn rows returned by scrape_menu into rows of the output file: the
+    flattened menu is replaced by the price statistics of the restaurant,
+    computed for all the rows in one pass (see menu_price.aggregate_prices)
+
+    Input:
+      rows (dict): the rows returned by scrape_menu, by restaurant index
+
+    Return:
+      (list of dict) a json serializable row with Id, the COLUMNS and the
+      STATS for every restaurant with a priced menu section, in the order
+      of rows
+    '''
+
+    stats = aggregate_prices(build_item_table(
+        {idx: row['Price'] for idx, row in rows.items()}))
+    pos = {idx: i for i, idx in enumerate(stats.index.tolist())}
+    values = {name: stats[name].tolist() for name in ['Price'] + STATS}
+    finished = []
+    for idx, row in rows.items():
+        if idx not in pos:
+            continue
+        row = dict(row, Id=idx)
+        for name in ['Price'] + STATS:
+            row[name] = values[name][pos[idx]]
+        finished.append(row)
+    return finished
+
+
+def read_raw_rows(path=ROWS_PATH):
+    '''
+    Read the rows of an NDJSON file as they were written, by url
+
+    Input:
+      path (str): the NDJSON file
+
+    Return:
+      (dict) the rows (dicts) by Url
+    '''
+
+    return {row['Url']: row for row in iter_ndjson(path)}
+
+
+def merge_rows(urls, fresh_urls, touched, path=ROWS_PATH,
+               fresh_path=ROWS_PATH + '.refresh'):
+    '''
+    Rewrite the rows file of a refreshed dataset (see Scraper.refresh): the
+    rows of fresh_urls come from the rescraped rows in fresh_path, the
+    other rows from path, the restaurants of touched getting the Scraped_At
+    of their rescrape. The rows are numbered in the order of urls, like the
+    merged dataframe, and fresh_path is removed.
+
+    Input:
+      urls (list of str): the urls of the merged dataframe, in order
+      fresh_urls (set of str): the restaurants that are new or changed
+      touched (set of str): the restaurants that were rescraped unchanged
+      path (str): the NDJSON file of the previous run, rewritten
+      fresh_path (str): the NDJSON file of the rescraped restaurants
+
+    Return:
+      (int) the number of urls that had no row in either file
+    '''
+
+    old = read_raw_rows(path) if os.path.exists(path) else {}
+    fresh = read_raw_rows(fresh_path)
+    missing = 0
+    writer = RowWriter(path + '.tmp')
+    for i, url in enumerate(urls):
+        row = fresh.get(url) if url in fresh_urls else old.get(url)
+        if row is None:
+            missing += 1
+            continue
+        if url in touched and url in fresh:
+            row['Scraped_At'] = fresh[url]['Scraped_At']
+        row['Id'] = i
+        writer.write(row)
+    writer.close()
+    os.replace(path + '.tmp', path)
+    os.remove(fresh_path)
+    return missing
+
+
+def max_row_id(path=ROWS_PATH):
+    '''
+    Find the highest restaurant id written to an NDJSON file of rows
+
+    Input:
+      path (str): the NDJSON file
+
+    Return:
+      (int) the highest Id, or -1 if the file has no rows
+    '''
+
+    return max((row['Id'] for row in iter_ndjson(path)), default=-1)
+
+
+def read_rows(path=ROWS_PATH):
+    '''
+    Read the rows written by Scraper.scrape_urls into a typed table. The
+    cuisines listed by each restaurant are mapped (see map_cuisine_column)
+    here, for all restaurants at once.
+
+    Input:
+      path (str): the NDJSON file
+
+    Return:
+      (pandas dataframe) indexed by restaurant index, with the COLUMNS (Price
+      as float64, Scraped_At as datetime64) and the STATS
+    '''
+
+    table = pd.DataFrame.from_records(list(iter_ndjson(path)),
+                                      columns=['Id'] + COLUMNS + STATS)
+    # a restaurant written just before an interruption is scraped again
+    table = table.drop_duplicates('Url', keep='last')
+    table = table.set_index('Id').rename_axis(None)
+    table['Coordinate'] = [tuple(c) if isinstance(c, list) else c
+                           for c in table['Coordinate']]
+    table['Cuisine'] = map_cuisine_column(table['Cuisine'])
+    table['Scraped_At'] = pd.to_datetime(
+        table['Scraped_At'].astype('float64'), unit='s')
+    return table.astype({'Price': 'float64', 'P25': 'float64',
+                         'P75': 'float64', 'Max': 'float64',
+                         'Items': 'int64', 'Sections': 'int64'})
+
+
+def load_rows(path=ROWS_PATH):
+    '''
+    Rebuild the dataframe returned by Scraper.scrape_menus from the rows
+    written to path
+
+    Input:
+      path (str): the NDJSON file
+
+    Return:
+      df (pandas dataframe): the COLUMNS and the cuisine dummy variables
+    '''
+
+    return add_cuisine_dummies(read_rows(path)[COLUMNS])
+
+
+def cuisine_vocabulary():
+    '''
+    Get the cuisines that restaurants can be mapped to, which are the values
+    of the mapping dictionary. Since the mapping dictionary is fixed, the
+    vocabulary (and the order of the dummy variables) is the same in every
+    run.
+
+    Return:
+      (list) the sorted cuisines
+    '''
+
+    return sorted(set(datasets.load('mapping_dict').values()))
+
+
+def add_cuisine_dummies(df, vocabulary=None):
+    '''
+    Add a dummy variable for every cuisine of the vocabulary. The dummy
+    variables are sparse uint8 columns built straight from the restaurants
+    that have the cuisine, so no dense column is ever allocated.
+
+    Input:
+      df (pandas dataframe): restaurants with a Cuisine column holding lists
+                             of cuisines
+      vocabulary (list): the cuisines to make dummy variables for, in order
+                         (defaults to cuisine_vocabulary())
+
+    Return:
+      df (pandas dataframe): df with one more column per cuisine
+    '''
+
+    if vocabulary is None:
+        vocabulary = cuisine_vocabulary()
+    mlb = MultiLabelBinarizer(classes=vocabulary, sparse_output=True)
+    matrix = mlb.fit_transform(df['Cuisine'])
+    dummies = pd.DataFrame.sparse.from_spmatrix(matrix.astype('uint8'),
+                                                index=df.index,
+                                                columns=vocabulary)
+    return pd.concat([df, dummies], axis=1)
 
             
-def scrape_menu(idx, url):
+def scrape_menu(idx, url, session=requests):
     '''
     Scrape a menu from single restaurant url. Retrieve the json file in the
     website and index through/process the data. Returns a dictionary that
     stores the information that is eventually converted into a dataframe in
-    Scraper.scrape_menus().
+    Scraper.scrape_menus(). "Price" holds the flattened menu items, which
+    Scraper.scrape_urls() aggregates in batches of restaurants, and
+    "Cuisine" the cuisines as listed on the page, which are mapped when the
+    rows are read back (see read_rows). "Hash"
+    is a hash of the ld+json payload, which Scraper.refresh() uses to tell
+    whether the restaurant changed.
 
     Input:
       idx (int): the index for the dictionary (that will become the index of
                  the dataframe in Scraper.scrape_menus)
       url (str): the restaurant url to scrape
+      session (object): anything with a get method, ex) a Fetcher (defaults
+                        to the requests module)
 
     Return:
       (dict) a dictionary that will become a row in the final data frame
              (created by Scraper.scrape_menus)
     '''
 
-    rqst = requests.get(url)
-    soup = BeautifulSoup(rqst.text, "html.parser")
-    tmp = soup.find("script", type="application/ld+json")
-    try:
-        restaurant_json = json.loads(tmp.text, strict=False)
-    except:
-        return None
-    section_prices = []
-    try:
-        menu_sections = restaurant_json["hasMenu"][0]["hasMenuSection"]
-        for section in menu_sections:
-            section_price = get_section_price(section)
-            if section_price:
-                section_prices.append(section_price)
-    except:
-        pass
-    if not section_prices:
+    rqst = session.get(url)
+    scraped_at = time()
+    with profiling.timer('parse.seconds'):
+        try:
+            payload = extract_ld_json(rqst.text)
+            restaurant_json = json.loads(payload, strict=False)
+        except:
+            return None
+        menu = flatten_menu(restaurant_json)
+    profiling.add('parse.menu_pages')
+    if not menu:
         return {}
-    return {idx: {"Cuisine": map_cuisines(restaurant_json["servesCuisine"]),
+    return {idx: {"Cuisine": restaurant_json["servesCuisine"],
                   "Restaurant": restaurant_json["name"],
                   "Coordinate": (restaurant_json["geo"]["longitude"], 
                                    restaurant_json["geo"]["latitude"]),
                   "Address": restaurant_json["address"]["streetAddress"],
-                  "Price": np.median(section_prices)}}
-
-
-def get_section_price(section):
-    '''
-    Get the mean price of a restaurant section ex) drinks, entree, main dish
-
-    Input:
-      section (dict): dictionary contaning the section information of a
-                      restaurant menu
-    Return:
-      (float) the mean price of this restaurnat menu section
-    '''
-
-    all_price = []
-    for item in section.get("hasMenuItem", []):
-        try:
-            all_price.append(float(item["offers"][-1]["Price"]))
-        except:
-            pass
-    if all_price:
-        return np.mean(all_price)
-    return None
+                  "Price": menu,
+                  "Url": url,
+                  "Hash": hashlib.sha1(payload.encode('utf-8')).hexdigest(),
+                  "Scraped_At": scraped_at}}
 
 
 def map_cuisines(cuisines):
@@ -197,9 +555,38 @@ def map_cuisines(cuisines):
       result (list): list of mapped cuisines
     '''
 
+    mapping_dict = datasets.load('mapping_dict')
     result = []
     for cuisine in cuisines:
         cuisine = clean_cuisine_name(cuisine)
-        if cuisine in MAPPING_DICT.keys():
-            result.append(MAPPING_DICT[cuisine])
+        if cuisine in mapping_dict.keys():
+            result.append(mapping_dict[cuisine])
     return result
+
+
+def map_cuisine_column(column, mapping_dict=None):
+    '''
+    Map the cuisine lists of many restaurants at once. Every distinct raw
+    cuisine name is cleaned and looked up once, and the lists are then mapped
+    through the resulting raw name -> category dictionary.
+
+    Input:
+      column (iterable of lists): the cuisines listed by each restaurant
+      mapping_dict (dict): the mapping dictionary (defaults to the one in
+                           MAPPING_PATH)
+
+    Returns
+      result (list of lists): the mapped cuisines of each restaurant, as
+                              map_cuisines would return them
+    '''
+
+    if mapping_dict is None:
+        mapping_dict = datasets.load('mapping_dict')
+    column = [c if isinstance(c, list) else [] for c in column]
+    lookup = {}
+    for cuisine in {c for cuisines in column for c in cuisines}:
+        cleaned = clean_cuisine_name(cuisine)
+        if cleaned in mapping_dict:
+            lookup[cuisine] = mapping_dict[cleaned]
+    return [[lookup[c] for c in cuisines if c in lookup]
+            for cuisines in column]
@@ -4,13 +4,13 @@ Execute a sample data collection and processing (1 Cuisine, 2 Restaruants)
 Nak Won Rim, Anqi Hu, Chia-yun Chang
 '''
 
-import scraper
-import tract_income
-import inspection
-import count_crime
-import pandas as pd
+import sys
+import pipeline
+import profiling
 
-def test():
+SAMPLE_ROWS_PATH = 'data/sample_rows.ndjson'
+
+def test(force=(), profile=False, dump=False):
     '''
     A test code for go() function in go.py. Scrapes only one cuisine from
     allmenus.com (resulting in two restaurants), add the census tract of
@@ -19,20 +19,22 @@ def test():
     within 0.8 kms of restaurant.
     Creates 'sample.pkl', which is a pickle file that containing the created
     sample data.
+    Runs the same pipeline as go() (see pipeline.py) without the response
+    cache, so only the stage results in 'data/pipeline/' are reused. The
+    scraped rows go to 'data/sample_rows.ndjson', leaving the rows of go()
+    alone.
+    profile and dump (python test.py --profile --dump) work like in go().
     '''
 
-    sc = scraper.Scraper()
-    sc.add_cuisine('Afghan')
-    sc.get_url_set()
-    df = sc.scrape_menus()
-    df['Tract'] = df['Address'].apply(tract_income.get_tract)
-    df['Income'] = df['Tract'].apply(tract_income.get_income)
-    df['Inspection'] = df.apply(inspection.get_inspection, axis=1)
-    df2 = pd.DataFrame(df['Coordinate'].apply(count_crime.count_crimes))
-    df = pd.merge(df, df2, left_index=True, right_index=True)
-    df.columns = [c.title() for c in df.columns]
-    df.drop(columns=['Address', 'Cuisine'], inplace=True)
-    df.to_pickle('sample.pkl')
+    pipe = pipeline.build(cuisines=['Afghan'], cached=False,
+                          rows_path=SAMPLE_ROWS_PATH)
+    if dump:
+        pipe.workers = 1
+    with profiling.profiled(profile, dump):
+        results = pipe.run(force)
+    results['final'].to_pickle('sample.pkl')
 
 if __name__ == "__main__":
-    test()
+    args = sys.argv[1:]
+    test([a for a in args if not a.startswith('--')], '--profile' in args,
+         '--dump' in args)
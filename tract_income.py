@@ -4,18 +4,62 @@ Getting census tract of restaurant and retrieving income data of that tract
 Nak Won Rim, Anqi Hu, Chia-yun Chang
 '''
 
+import os
 import re
+import io
+import csv
+import requests
 import pandas as pd
 import numpy as np
 import censusgeocode as cg
+import datasets
+import profiling
+from time import sleep
+from address import normalize_address
+from concurrent.futures import ThreadPoolExecutor
 
-INCOME = pd.read_csv('data/Income_by_Location.csv')
-INCOME = INCOME[INCOME['Year'] == 2017][['Household Income by Race',
-                                         'Geography']]
-INCOME['Tract'] = [re.sub(', .*', '', i.strip('Census Tract')) for i in 
-                   INCOME['Geography']]
-INCOME.drop(columns=['Geography'], inplace=True)
-INCOME.columns = ['Income', 'Tract']
+BATCH_URL = ('https://geocoding.geo.census.gov/geocoder/geographies/' +
+             'addressbatch')
+BENCHMARK = 'Public_AR_Current'
+VINTAGE = 'Census2010_Current'
+BATCH_SIZE = 10000
+WORKERS = 4
+TIMEOUT = 600
+# the addresses of a failed batch are retried one at a time, with a shorter
+# timeout and a growing pause after every failure, until MAX_FAILURES
+# requests in a row failed
+SINGLE_TIMEOUT = 30
+BACKOFF = 1
+MAX_FAILURES = 3
+# the batch status of an address with several matches
+TIE = 'Tie'
+TRACT_SHAPE_PATH = 'data/tracts/tl_2010_17031_tract10.shp'
+TRACT_CODE_COL = 'TRACTCE10'
+CELL = 0.01
+TRACT_INDEX = None
+
+INCOME_PATH = 'data/Income_by_Location.csv'
+YEAR = 2017
+INCOME_BY_YEAR = {}
+
+
+def read_income(path):
+    '''
+    Read the income dataset, keeping only the year, income and geography
+    columns
+
+    Inputs:
+        path(str): the csv file of the income dataset
+
+    Outputs:
+        (pandas dataframe) the income dataset
+    '''
+
+    return pd.read_csv(path, usecols=['Year', 'Household Income by Race',
+                                      'Geography'])
+
+
+datasets.register('income', INCOME_PATH, read_income)
 
 
 def get_tract(address):
@@ -30,32 +74,394 @@ def get_tract(address):
         tract_num(str): the tract number of the address or NaN.
     '''
 
-    info = cg.address(address.upper(), city='Chicago', state='IL')
+    info = cg.address(normalize_address(address), city='Chicago',
+                      state='IL')
     if info:
         tract = info[0]['geographies']['2010 Census Blocks'][0]['TRACT']
-        t = tract[:4] + '.' + tract[-2:]
-        t = t.strip('0')
-        tract_num = t.strip('.')
+        tract_num = format_tract(tract)
     else: 
         tract_num = np.nan
     return tract_num
 
 
-def get_income(tract):
+def format_tract(tract):
+    '''
+    Turn a 6 digit census tract code into the tract number used in the
+    income dataset ex) 081500 -> 815, 010201 -> 102.01
+
+    Inputs:
+        tract(str): the 6 digit tract code
+
+    Outputs:
+        (str) the tract number
+    '''
+
+    t = tract[:4] + '.' + tract[-2:]
+    t = t.strip('0')
+    return t.strip('.')
+
+
+def geocode_batch(addresses, url=BATCH_URL, timeout=TIMEOUT):
+    '''
+    Geocode addresses with one request to the Census Geocoder batch endpoint
+
+    Inputs:
+        addresses(list of str): at most BATCH_SIZE street addresses
+        url(str): the batch endpoint
+        timeout(float): the seconds to wait for the response
+
+    Outputs:
+        tracts(dict): the tract number of the position of every address in
+            the list. Addresses without a match map to None, addresses with
+            several matches to TIE
+    '''
+
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for i, address in enumerate(addresses):
+        writer.writerow([i, address.upper(), 'Chicago', 'IL', ''])
+    with profiling.timer('geocode.network_seconds'):
+        rqst = requests.post(url, data={'benchmark': BENCHMARK,
+                                        'vintage': VINTAGE},
+                             files={'addressFile': ('addresses.csv',
+                                                    buf.getvalue())},
+                             timeout=timeout)
+    profiling.add('geocode.requests')
+    rqst.raise_for_status()
+    tracts = {}
+    for row in csv.reader(io.StringIO(rqst.text)):
+        if not row:
+            continue
+        if len(row) >= 11 and row[2] == 'Match':
+            tracts[int(row[0])] = format_tract(row[10])
+        elif len(row) >= 3 and row[2] == TIE:
+            tracts[int(row[0])] = TIE
+        else:
+            tracts[int(row[0])] = None
+    return tracts
+
+
+def get_tracts(addresses, cache=None, batch_size=BATCH_SIZE,
+               workers=WORKERS, url=BATCH_URL):
+    '''
+    Obtains the census tract of many addresses with the batch endpoint. The
+    addresses are normalized (see address.normalize_address), and the
+    unique normalized addresses are split into chunks of batch_size that are
+    sent at the same time. If the request of a chunk fails, its addresses
+    are sent again one at a time (see geocode_singles). Addresses with
+    several matches (TIE) are looked up one at a time with get_tract, which
+    takes the first match.
+
+    Inputs:
+        addresses(pandas Series): street addresses of restaurants
+        cache(KeyValueStore): normalized address -> tract cache. Addresses
+            found in it are not geocoded again and the tracts found are
+            added to it; addresses without a tract are not, so they are
+            tried again by the next run (optional)
+        batch_size(int): the number of addresses per request
+        workers(int): the number of requests sent at the same time
+        url(str): the batch endpoint
+
+    Outputs:
+        (pandas Series) the tract number of every address or NaN, indexed
+        like addresses
+    '''
+
+    keys = [normalize_address(a) for a in addresses]
+    unique = list(dict.fromkeys(keys))
+    known = cache.get_many(unique) if cache is not None else {}
+    todo = [a for a in unique if a not in known]
+    if cache is not None:
+        profiling.add('geocode_cache.hits', len(known))
+        profiling.add('geocode_cache.misses', len(todo))
+    chunks = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+
+    def geocode(chunk):
+        try:
+            tracts = geocode_batch(chunk, url)
+        except (requests.RequestException, ValueError):
+            tracts = geocode_singles(chunk, url)
+        tracts = {chunk[i]: tract for i, tract in tracts.items()}
+        for address, tract in tracts.items():
+            if tract == TIE:
+                tracts[address] = resolve_tie(address)
+        return tracts
+
+    found = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for result in executor.map(geocode, chunks):
+            found.update(result)
+    if cache is not None:
+        cache.put_many({address: tract for address, tract in found.items()
+                        if tract is not None})
+    known.update(found)
+    tracts = [known.get(k) for k in keys]
+    return pd.Series([np.nan if t is None else t for t in tracts],
+                     index=addresses.index, dtype=object)
+
+
+def geocode_singles(addresses, url=BATCH_URL):
+    '''
+    Geocode the addresses of a failed batch one request at a time, pausing
+    BACKOFF seconds after a failure, twice as long after the next one, and
+    giving up on the rest once MAX_FAILURES requests in a row failed
+
+    Inputs:
+        addresses(list of str): the street addresses of the failed batch
+        url(str): the batch endpoint
+
+    Outputs:
+        tracts(dict): the tract number (or None, or TIE, see geocode_batch)
+            of the position of every address that was geocoded
+    '''
+
+    tracts = {}
+    failures = 0
+    for i, address in enumerate(addresses):
+        try:
+            tracts[i] = geocode_batch([address], url, SINGLE_TIMEOUT)[0]
+            failures = 0
+        except (requests.RequestException, ValueError, KeyError):
+            failures += 1
+            if failures >= MAX_FAILURES:
+                profiling.add('geocode.abandoned', len(addresses) - i - 1)
+                break
+            sleep(BACKOFF * 2 ** (failures - 1))
+    return tracts
+
+
+def resolve_tie(address):
+    '''
+    Look up an address the batch endpoint found several matches for with
+    the single address endpoint (see get_tract)
+
+    Inputs:
+        address(str): the normalized street address
+
+    Outputs:
+        (str) the tract number of the first match, or None if there is none
+        or the request failed
+    '''
+
+    try:
+        tract = get_tract(address)
+    except (requests.RequestException, ValueError, KeyError, IndexError):
+        return None
+    return None if pd.isna(tract) else tract
+
+
+def polygon_edges(geometry):
+    '''
+    Get the edges of every ring (outer boundaries and holes) of a Polygon or
+    MultiPolygon
+
+    Inputs:
+        geometry(shapely geometry): the tract shape
+
+    Outputs:
+        (numpy array) one row (x1, y1, x2, y2) per edge
+    '''
+
+    polygons = getattr(geometry, 'geoms', [geometry])
+    edges = []
+    for polygon in polygons:
+        for ring in [polygon.exterior] + list(polygon.interiors):
+            xy = np.asarray(ring.coords)[:, :2]
+            edges.append(np.hstack([xy[:-1], xy[1:]]))
+    return np.vstack(edges)
+
+
+class TractIndex():
+    '''
+    class storing census tract polygons in a uniform grid for point in
+    polygon lookups
+    '''
+
+    def __init__(self, tracts, code_col=TRACT_CODE_COL, cell=CELL):
+        '''
+        Constructor for the TractIndex class
+
+        Inputs:
+            tracts(geopandas GeoDataFrame): tract shapes in longitude and
+                latitude
+            code_col(str): the column with the 6 digit tract code
+            cell(float): the size of a grid cell in degrees
+        '''
+
+        self.cell = cell
+        self.tracts = [format_tract(code) for code in tracts[code_col]]
+        self.edges = [polygon_edges(g) for g in tracts.geometry]
+        self.grid = {}
+        for i, edges in enumerate(self.edges):
+            col_lo, row_lo = self.cell_of(edges[:, 0].min(),
+                                          edges[:, 1].min())
+            col_hi, row_hi = self.cell_of(edges[:, 0].max(),
+                                          edges[:, 1].max())
+            for col in range(col_lo, col_hi + 1):
+                for row in range(row_lo, row_hi + 1):
+                    self.grid.setdefault((col, row), []).append(i)
+
+
+    def __len__(self):
+        '''
+        Number of tracts in the index
+        '''
+
+        return len(self.tracts)
+
+
+    def cell_of(self, lon, lat):
+        '''
+        Find the grid cell (column, row) of a location
+
+        Inputs:
+            lon, lat (float): the coordinate
+
+        Outputs:
+            (tuple) the column and row numbers of the cell
+        '''
+
+        return int(np.floor(lon / self.cell)), int(np.floor(lat / self.cell))
+
+
+    def assign(self, lon, lat):
+        '''
+        Find the tract of every point. Points are grouped by grid cell and
+        tested against the tracts of their cell all at once with the even-odd
+        rule.
+
+        Inputs:
+            lon, lat (numpy arrays): the coordinates of the points
+
+        Outputs:
+            (numpy array) the position of the tract of every point in
+            self.tracts, or -1 for points outside every tract
+        '''
+
+        found = np.full(len(lon), -1)
+        cols = np.floor(lon / self.cell)
+        rows = np.floor(lat / self.cell)
+        valid = np.isfinite(cols) & np.isfinite(rows)
+        cells = {}
+        for i in np.flatnonzero(valid):
+            cells.setdefault((int(cols[i]), int(rows[i])), []).append(i)
+        for cell, points in cells.items():
+            points = np.array(points)
+            for tract in self.grid.get(cell, []):
+                todo = points[found[points] == -1]
+                if not len(todo):
+                    break
+                x1, y1, x2, y2 = self.edges[tract].T
+                px, py = lon[todo, None], lat[todo, None]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cross = (((y1 > py) != (y2 > py)) &
+                             (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1))
+                inside = cross.sum(axis=1) % 2 == 1
+                found[todo[inside]] = tract
+        return found
+
+
+def get_tract_index():
+    '''
+    Get the tract polygon index, reading TRACT_SHAPE_PATH on the first call
+
+    Outputs:
+        (TractIndex) the index of the tract polygons
+    '''
+
+    global TRACT_INDEX
+    if TRACT_INDEX is None:
+        import geopandas as gpd
+        tracts = gpd.read_file(TRACT_SHAPE_PATH)
+        if tracts.crs is not None:
+            tracts = tracts.to_crs(epsg=4326)
+        TRACT_INDEX = TractIndex(tracts)
+    return TRACT_INDEX
+
+
+def assign_tracts(coordinates):
+    '''
+    Obtains the census tract of every restaurant from its coordinate, without
+    any network request. Without the tract shapefile (TRACT_SHAPE_PATH), no
+    restaurant gets a tract, so they are all geocoded (see get_tracts).
+
+    Inputs:
+        coordinates(pandas Series): (longitude, latitude) of restaurants
+
+    Outputs:
+        (pandas Series) the tract number of every restaurant, or NaN if the
+        coordinate is not in any tract, indexed like coordinates
+    '''
+
+    if TRACT_INDEX is None and not os.path.exists(TRACT_SHAPE_PATH):
+        print('{} is missing, geocoding every restaurant'.format(
+            TRACT_SHAPE_PATH))
+        return pd.Series(np.nan, index=coordinates.index, dtype=object)
+    index = get_tract_index()
+    lon = pd.to_numeric(coordinates.str[0], errors='coerce').to_numpy(
+        dtype='float64')
+    lat = pd.to_numeric(coordinates.str[1], errors='coerce').to_numpy(
+        dtype='float64')
+    found = index.assign(lon, lat)
+    # found is -1 for points outside every tract, which picks the NaN
+    tracts = np.array(index.tracts + [np.nan], dtype=object)
+    return pd.Series(tracts[found], index=coordinates.index)
+
+
+def income_table(year=YEAR):
+    '''
+    Get the median household income of every tract for a year, indexed by
+    tract number. The table of each year is built once and kept in
+    INCOME_BY_YEAR.
+
+    Inputs:
+        year(int): the year of the income data
+
+    Outputs:
+        (pandas Series) the income of every tract, indexed by tract number.
+        If a tract has more than one row, the first one is kept
+    '''
+
+    if year not in INCOME_BY_YEAR:
+        income = datasets.load('income')
+        income = income[income['Year'] == year]
+        tracts = [re.sub(', .*', '', i.strip('Census Tract')) for i in 
+                  income['Geography']]
+        table = pd.Series(income['Household Income by Race'].values,
+                          index=tracts, name='Income')
+        INCOME_BY_YEAR[year] = table[~table.index.duplicated()]
+    return INCOME_BY_YEAR[year]
+
+
+def get_incomes(tracts, year=YEAR):
+    '''
+    Matches income from the median household income dataset for many tracts
+    with a single reindex
+
+    Inputs:
+        tracts(pandas Series): census tract numbers
+        year(int): the year of the income data
+
+    Outputs:
+        (pandas Series) the annual median household income of every tract,
+        or NaN if no matching income was found, indexed like tracts
+    '''
+
+    incomes = income_table(year).reindex(tracts.values)
+    return pd.Series(incomes.values, index=tracts.index, name='Income')
+
+
+def get_income(tract, year=YEAR):
     '''
     Matches income from the median household income dataset
 
     Inputs:
         tract(str): the census tract number 
+        year(int): the year of the income data
 
     Outputs:
         The annual median household income for the census tract. If no 
         matching income was found, return NaN.
     '''
 
-    income = INCOME[INCOME['Tract'] == tract]['Income']
-    if not income.empty:
-        return income.iloc[0]
-    return np.nan
-
- 
\ No newline at end of file
+    return income_table(year).get(tract, np.nan)